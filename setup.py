@@ -67,7 +67,8 @@ setup(
     ],
 
     include_package_data=True,
-    package_data={'': ['datasets/*.csv', 'datasets/*.csv.gz']},
+    package_data={'': ['datasets/*.csv', 'datasets/*.csv.gz',
+                      'datasets/LR_data/*.csv', 'datasets/LR_data/*.csv.gz']},
 
     extras_require={
         'docs': [
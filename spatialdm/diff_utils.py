@@ -1,44 +1,73 @@
 import pandas as pd
 import numpy as np
 import anndata as ann
-from statsmodels.stats.multitest import fdrcorrection
+import h5py
+from .fdr import fdr_bh
+from .store import read_spatialdm_store
+from .lr_db import load_lr_db, LRIndex, lr_index
 
-def concat_db(adatas, species):
+_GLOBAL_TABLES = ['ligand', 'receptor', 'geneInter', 'global_res']
+
+def _global_results(sample):
+    """
+    The global results of one sample as an AnnData with obs, uns['ligand', 'receptor', 'geneInter', 'global_res'] \
+    and uns['lr_index'] (if saved) only.
+    :param sample: spatialdm obj, or the path of a file from write_spatialdm_h5ad or write_spatialdm_store. \
+    Expression data is never read from files.
+    """
+    if isinstance(sample, ann.AnnData):
+        return ann.AnnData(obs=sample.obs, uns={k: sample.uns[k] for k in _GLOBAL_TABLES + ['lr_index']
+                                                if k in sample.uns})
+    with h5py.File(sample, 'r') as f:
+        is_store = 'tables' in f and 'obs' not in f
+    if is_store:
+        with read_spatialdm_store(sample) as store:
+            uns = {k: store.table(k) for k in _GLOBAL_TABLES}
+            if 'lr_index' in store.file:
+                uns['lr_index'] = store.lr_index().to_dict()
+            return ann.AnnData(obs=pd.DataFrame(index=store.spots), uns=uns)
+    adata = ann.read_h5ad(sample, backed='r')
+    uns = {k: adata.uns[k].replace('NA', np.nan) for k in _GLOBAL_TABLES}
+    if 'lr_index' in adata.uns:
+        uns['lr_index'] = adata.uns['lr_index']
+    obs = adata.obs.copy()
+    adata.file.close()
+    return ann.AnnData(obs=obs, uns=uns)
+
+def concat_db(adatas, species, datahost='builtin'):
     """
     Merge all interaction database from a list of spatialdm obj.
     :param samples: a list of spatialdm obj to be merged.
     :param species: str. 'human' or 'mouse'.
+    :param datahost: the host of the ligand-receptor data, see load_lr_db.
     :return:
     """
-    if species == 'mouse':
-        geneInter = pd.read_csv('https://figshare.com/ndownloader/files/36638919', index_col=0)
-        comp = pd.read_csv('https://figshare.com/ndownloader/files/36638916', header=0, index_col=0)
-    elif species == 'human':
-        geneInter = pd.read_csv('https://figshare.com/ndownloader/files/36638943', header=0, index_col=0)
-        comp = pd.read_csv('https://figshare.com/ndownloader/files/36638940', header=0, index_col=0)
-    else:
-        raise ValueError("species type: {} is not supported currently. Please have a check.".format(species))
-    ligand = pd.concat([sample.uns['ligand'] for sample in adatas], axis=1)
-    receptor = pd.concat([sample.uns['receptor'] for sample in adatas], axis=1)
-    ligand=ligand[~ligand.index.duplicated()]
-    receptor=receptor[~receptor.index.duplicated()]
-    geneInter = geneInter.loc[ligand.index]
+    geneInter, comp = load_lr_db(species, datahost)
+    # pairs of all samples, each in the order of its first occurrence
+    index = LRIndex.concat([lr_index(sample) for sample in adatas])
+    ligand, receptor = index.to_tables()
+    geneInter = geneInter.loc[index.pairs]
     return ligand, receptor, geneInter
 
-def concat_obj(samples, names, species, method='z-score', fdr=False):
+def concat_obj(samples, names, species, method='z-score', fdr=False, datahost='builtin'):
     # def __init__(self, samples, names, species, method='z-score', fdr=False):
     """
-    Merge all global results from a list of spatialdm obj
-    :param samples: a list of spatialdm obj to be merged.
+    Merge all global results from a list of spatialdm obj. Only obs and the global result tables are \
+    merged, the returned object has no expression matrix and the samples are not modified.
+    :param samples: a list of spatialdm obj to be merged, or paths of files saved by write_spatialdm_h5ad \
+    or write_spatialdm_store (only their obs and global results are read).
     :param names: a list of str for each sample's name.
     :param species: str. 'human' or 'mouse'.
     :param dir_db']: dir containing 0_CellChatdb'] folder.
     :param method: 'z-score' or 'permutation'. Should be the commonly selected method from all samples.
     :param fdr: If use fdr or p-values for differential analysis
+    :param datahost: the host of the ligand-receptor data, see load_lr_db.
     """
-    cdata = ann.concat(samples, join='outer')
+    samples = [_global_results(sample) for sample in samples]
+    cdata = ann.AnnData(obs=pd.concat([sample.obs for sample in samples], join='outer'))
     cdata.obs['batch'] = np.repeat(names, [sample.shape[0] for sample in samples])
-    cdata.uns['ligand'], cdata.uns['receptor'], cdata.uns['geneInter'] = concat_db(samples, species)
+    cdata.uns['ligand'], cdata.uns['receptor'], cdata.uns['geneInter'] = concat_db(samples, species, datahost)
+    lr_index(cdata)
     n_samples = len(samples)
     cdata.uns['method'] = method
     cdata.uns['p_df'] = pd.DataFrame(np.zeros((cdata.uns['ligand'].shape[0], n_samples)),
@@ -47,74 +76,94 @@ def concat_obj(samples, names, species, method='z-score', fdr=False):
     if method == 'z-score':
         cdata.uns['zscore_df'] = cdata.uns['p_df'].copy()
         for sample, d in zip(samples, names):
-            sample.uns['global_res']['z'] = pd.Series(sample.uns['global_res']['z'],
-                                                       index=sample.uns['ligand'].index)
+            global_res = sample.uns['global_res']
             if fdr:
-                cdata.uns['p_df'][d] = sample.uns['global_res'].fdr
+                cdata.uns['p_df'][d] = pd.to_numeric(global_res.fdr)
             else:
-                cdata.uns['p_df'][d] = sample.uns['global_res'].z_pval
+                cdata.uns['p_df'][d] = pd.to_numeric(global_res.z_pval)
             cdata.uns['p_df'][d] = np.where(np.isnan(cdata.uns['p_df'][d]), 1, cdata.uns['p_df'][d])
-            cdata.uns['zscore_df'][d] = sample.uns['global_res']['z']
+            cdata.uns['zscore_df'][d] = pd.to_numeric(global_res['z'])
             cdata.uns['zscore_df'][d] = np.where(np.isnan(cdata.uns['zscore_df'][d]), 0, cdata.uns['zscore_df'][d])
-            cdata.uns['tf_df'][d] = sample.uns['global_res'].selected
+            cdata.uns['tf_df'][d] = global_res.selected
     elif method == 'permutation':
         print('This function to be updated') #TODO: update!
         for sample, d in zip(samples, names):
-            sample.uns['z']['z'] = pd.Series(sample.uns['z']['z'], sample.uns['global_res'].index)
+            global_res = sample.uns['global_res']
             if fdr:
-                cdata.uns['p_df'][d] = sample.uns['global_res'].fdr
+                cdata.uns['p_df'][d] = pd.to_numeric(global_res.fdr)
             else:
-                cdata.uns['p_df'][d] = sample.uns['global_res'].perm_pval
+                cdata.uns['p_df'][d] = pd.to_numeric(global_res.perm_pval)
     else:
         raise ValueError("Only one of ['z-score', 'permutation'] is supported")
     cdata.uns['tf_df'] = cdata.uns['tf_df'].fillna(False)
     cdata.uns['tf_df'] = cdata.uns['tf_df'].astype(bool)
     return cdata
 
-def differential_test(cdata, subset, conditions):
+def likelihood_ratio_test(Y, X_full, X_reduced):
+    """
+    Likelihood ratio test of nested Gaussian linear models for many responses sharing one design.
+    Both models are fitted to all columns of Y by a single least-squares solve, and the statistic
+    -2 * (llf_reduced - llf_full) reduces to n * log(RSS_reduced / RSS_full).
+    :param Y: (n_obs, n_responses) responses, e.g. z-scores of samples x pairs
+    :param X_full: (n_obs, k_full) design matrix of the full model
+    :param X_reduced: (n_obs, k_reduced) design matrix of the reduced model, nested in the full one
+    :return: LR statistics (n_responses,), chi-square p-values (n_responses,), \
+    full model coefficients (k_full, n_responses) and the degrees of freedom
+    """
+    from scipy.stats import chi2
+    Y = np.asarray(Y, dtype=np.float64)
+    coef, _, rank_full, _ = np.linalg.lstsq(X_full, Y, rcond=None)
+    rss_full = ((Y - X_full @ coef) ** 2).sum(0)
+    coef_reduced, _, rank_reduced, _ = np.linalg.lstsq(X_reduced, Y, rcond=None)
+    rss_reduced = ((Y - X_reduced @ coef_reduced) ** 2).sum(0)
+    df = rank_full - rank_reduced
+    # residuals at rounding level are exact fits, a constant response then gives nan (p-value 1) not noise
+    tol = np.finfo(np.float64).eps * Y.shape[0] * (Y ** 2).max(0, initial=0)
+    rss_full[rss_full <= tol] = 0
+    rss_reduced[rss_reduced <= tol] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        LR_statistic = Y.shape[0] * (np.log(rss_reduced) - np.log(rss_full))
+    return LR_statistic, chi2.sf(LR_statistic, df), coef, df
+
+def differential_test(cdata, subset, conditions, covariates=None):
     """
     Test whether each pair is differential among 2 or more conditions by likehood ratio
     :param subset: list of concat_obj names to perform differential test on.
-    :param conditions: numeric label distinguishing conditions for each selected sample from the subset
+    :param conditions: numeric label distinguishing conditions for each selected sample from the subset, \
+    or a (n_sub, k) matrix of condition covariates, all tested jointly (k degrees of freedom)
+    :param covariates: optional (n_sub,) or (n_sub, m) covariates kept in both the full and the reduced model
     :return:
         cdata.uns['p_val']: dataframe containing differential p-values
         cdata.uns['diff_fdr']: dataframe containing fdr corrected differential p-values
+        cdata.uns['LR_statistic']: likelihood ratio statistics
+        cdata.uns['diff_coef']: dataframe of the condition coefficients (effect sizes) of the full model
+        cdata.uns['diff']: z-score difference between conditions 1 and 0, for a single condition column only
     """
     if cdata.uns['method'] == 'z-score':
-        import statsmodels.api as sm
-        import scipy
         cdata.uns['subset'] = subset
         cdata.uns['conditions'] = conditions
         n_sub = len(subset)
         cdata.uns['n_sub'] = n_sub
-        LR_statistic = np.zeros((len(cdata.uns['p_df'])))
-        cdata.uns['p_val'] = np.zeros((len(cdata.uns['p_df'])))
-        x = conditions
-        for i in range(len(cdata.uns['p_df'])):
-            # full model
-            p = cdata.uns['zscore_df'].index[i]
-            y = np.where(cdata.uns['zscore_df'].loc[p, subset].isna(), 0, cdata.uns['zscore_df'].loc[p, subset].values)
-            y1 = y
-            x1 = np.vstack((np.ones(n_sub), x)).T
-            full_model = sm.OLS(y1, x1).fit()
-            full_ll = full_model.llf
-
-            # reduced model
-            y2 = y
-            x2 = np.ones(n_sub)
-            reduced_model = sm.OLS(y2, x2).fit()
-            reduced_ll = reduced_model.llf
-
-            # calculate likelihood ratio Chi-Squared test statistic
-            LR_statistic[i] = -2 * (reduced_ll - full_ll)
-            cdata.uns['p_val'][i] = scipy.stats.chi2.sf(LR_statistic[i], 1)
-
-        cdata.uns['diff'] = cdata.uns['zscore_df'].loc[:, np.array(subset)[conditions == 1]].mean(1) - \
-                    cdata.uns['zscore_df'].loc[:, np.array(subset)[conditions == 0]].mean(1)
+        Y = cdata.uns['zscore_df'].loc[:, subset].fillna(0).values.T
+        x = np.asarray(conditions, dtype=np.float64).reshape(n_sub, -1)
+        X_reduced = np.ones((n_sub, 1))
+        if covariates is not None:
+            X_reduced = np.hstack((X_reduced, np.asarray(covariates, dtype=np.float64).reshape(n_sub, -1)))
+        X_full = np.hstack((X_reduced, x))
+        LR_statistic, p_val, coef, _ = likelihood_ratio_test(Y, X_full, X_reduced)
+        cdata.uns['LR_statistic'] = LR_statistic
+        cdata.uns['p_val'] = p_val
+        cdata.uns['diff_coef'] = pd.DataFrame(coef[X_reduced.shape[1]:].T, index=cdata.uns['zscore_df'].index)
+
+        # mean difference between the two groups, only defined for a single 0 / 1 condition
+        cdata.uns.pop('diff', None)
+        if x.shape[1] == 1:
+            cdata.uns['diff'] = cdata.uns['zscore_df'].loc[:, np.array(subset)[conditions == 1]].mean(1) - \
+                        cdata.uns['zscore_df'].loc[:, np.array(subset)[conditions == 0]].mean(1)
 
         cdata.uns['p_val'] = np.where(np.isnan(cdata.uns['p_val']), 1, cdata.uns['p_val'])
 
-        cdata.uns['diff_fdr'] = fdrcorrection(cdata.uns['p_val'])[1]
+        cdata.uns['diff_fdr'] = fdr_bh(cdata.uns['p_val'])
 
 def group_differential_pairs(cdata, c1_name, c2_name, diff_quantile1=0.7, diff_quantile2=0.3, fdr_co=0.1):
     '''
@@ -126,6 +175,9 @@ def group_differential_pairs(cdata, c1_name, c2_name, diff_quantile1=0.7, diff_q
     :param fdr_co: (float) fdr cutoff
     :return: specific pairs for c1 and c2
     '''
+    if 'diff' not in cdata.uns:
+        raise ValueError("group_differential_pairs needs differential_test with a single 0/1 condition column, "
+                         "use cdata.uns['diff_coef'] for multi-column conditions")
     _range = np.arange(1, cdata.uns['n_sub'])
     cdata.uns['q1'] = np.quantile(cdata.uns['diff'], diff_quantile1)
     cdata.uns['q2'] = np.quantile(cdata.uns['diff'], diff_quantile2)
@@ -0,0 +1,98 @@
+"""
+Benjamini-Hochberg FDR for large p-value arrays
+"""
+import numpy as np
+
+
+def _chunks(n, chunk_size):
+    return [slice(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+
+def fdr_bh(p, out=None, chunk_size=2 ** 22):
+    """Benjamini-Hochberg adjusted p-values, as statsmodels' fdrcorrection, for arrays of any shape.
+
+    Instead of argsorting in float64, one sorted copy of the p-values is kept in their own precision
+    (float32 p-values stay float32). The adjusted values are computed from it chunk by chunk and every
+    p-value is mapped to the value of its last tie by binary search. NaNs are not counted as tests
+    and stay NaN.
+
+    :param p: p-values, array of any shape
+    :param out: C-contiguous array of the same shape to write the result to, may be p itself (in place)
+    :param chunk_size: number of p-values handled per step
+    :return: adjusted p-values with the shape of p, in its (floating) dtype
+    """
+    p = np.asarray(p)
+    dtype = p.dtype if p.dtype.kind == 'f' else np.float64
+    flat = p.reshape(-1)
+    s = flat[~np.isnan(flat)].astype(dtype, copy=False)
+    s.sort()
+    n = len(s)
+
+    # q_k = min_{j >= k} p_(j) * n / j, from the largest p-value down
+    q = np.empty_like(s)
+    running = np.inf
+    for sl in reversed(_chunks(n, chunk_size)):
+        q_sl = s[sl] * (n / np.arange(sl.start + 1, sl.stop + 1, dtype=np.float64))
+        q_sl = np.minimum(np.minimum.accumulate(q_sl[::-1])[::-1], running)
+        running = q_sl[0]
+        q[sl] = np.minimum(q_sl, 1)
+
+    if out is None:
+        out = np.empty(p.shape, dtype=dtype)
+    out_flat = out.reshape(-1)
+    for sl in _chunks(flat.size, chunk_size):
+        x = flat[sl]
+        res = q[np.clip(np.searchsorted(s, x, side='right') - 1, 0, None)] if n > 0 \
+            else np.full(x.shape, np.nan, dtype=dtype)
+        res[np.isnan(x)] = np.nan
+        out_flat[sl] = res
+    return out
+
+
+def fdr_bh_chunked(p, out=None, chunk_size=2 ** 22, precision_bits=15):
+    """Conservative Benjamini-Hochberg adjusted p-values in two streaming passes over row chunks.
+
+    The first pass counts p-values in buckets of their float32 bit pattern (the top precision_bits
+    bits of the mantissa), the second writes the adjusted value of each bucket, computed from the
+    bucket's upper edge and its highest rank. Only the bucket counts are resident, so p can be a
+    memory-mapped or on-disk array (e.g. the local stage's store) larger than memory. Up to float32
+    rounding, the result is never below the exact value and, above the float32 subnormal range,
+    exceeds it by at most a relative 2 ** -precision_bits.
+
+    :param p: p-values, array sliceable along its first axis (ndarray, np.memmap, h5py dataset)
+    :param out: array of the same shape to write the result to, may be p itself (in place)
+    :param chunk_size: approximate number of p-values per chunk of rows
+    :param precision_bits: mantissa bits per bucket, at most 23
+    :return: adjusted p-values with the shape of p, in float32
+    """
+    shift = np.uint32(23 - precision_bits)
+    n_buckets = (int(np.float32(1).view(np.uint32)) >> int(shift)) + 1
+    row_size = int(np.prod(p.shape[1:], dtype=np.int64))
+    rows = [slice(r.start, r.stop) for r in _chunks(p.shape[0], max(1, chunk_size // max(row_size, 1)))]
+
+    def buckets(x):
+        x = np.clip(np.asarray(x, dtype=np.float32), 0, 1)
+        return x.view(np.uint32) >> shift
+
+    counts = np.zeros(n_buckets, dtype=np.int64)
+    for sl in rows:
+        x = np.asarray(p[sl], dtype=np.float32)
+        counts += np.bincount(buckets(x[~np.isnan(x)]), minlength=n_buckets)
+    n = counts.sum()
+
+    # every p-value of bucket b ranks at most cum[b] and is at most the bucket's upper edge
+    cum = np.cumsum(counts)
+    edge = np.minimum(((np.arange(1, n_buckets + 1, dtype=np.uint64) << np.uint64(shift)) - 1)
+                      .astype(np.uint32).view(np.float32), 1).astype(np.float64)
+    q = np.where(counts > 0, edge * n / np.maximum(cum, 1), np.inf)
+    q = np.minimum(np.minimum.accumulate(q[::-1])[::-1], 1).astype(np.float32)
+
+    if out is None:
+        out = np.empty(p.shape, dtype=np.float32)
+    for sl in rows:
+        x = np.asarray(p[sl], dtype=np.float32)
+        res = q[buckets(np.nan_to_num(x))]
+        res[x <= 0] = 0
+        res[np.isnan(x)] = np.nan
+        out[sl] = res
+    return out
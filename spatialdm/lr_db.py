@@ -0,0 +1,266 @@
+"""
+Ligand-receptor database (CellChatDB) loading, cached in memory and on disk
+"""
+import os
+import pickle
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+LR_DATA = os.path.join(os.path.dirname(__file__), 'datasets', 'LR_data')
+CACHE_DIR = os.path.expanduser('~/.cache/spatialdm/lr_db')
+
+# packaged files are named by these prefixes
+_PACKAGE_PREFIX = {'human': 'human', 'mouse': 'mouse', 'zebrafish': 'zerafish', 'zerafish': 'zerafish'}
+# (interaction, complex) tables on figshare
+_FIGSHARE = {'human': ('https://figshare.com/ndownloader/files/36638943',
+                       'https://figshare.com/ndownloader/files/36638940'),
+             'mouse': ('https://figshare.com/ndownloader/files/36638919',
+                       'https://figshare.com/ndownloader/files/36638916'),
+             'zebrafish': ('https://figshare.com/ndownloader/files/38756022',
+                           'https://figshare.com/ndownloader/files/38756019')}
+
+
+def _sources(species, datahost):
+    if datahost in ['builtin', 'package']:
+        if species not in _PACKAGE_PREFIX:
+            raise ValueError("species type: {} is not supported currently. Please have a check.".format(species))
+        prefix = os.path.join(LR_DATA, _PACKAGE_PREFIX[species] + '-')
+        paths = (prefix + 'interaction_input_CellChatDB.csv.gz', prefix + 'complex_input_CellChatDB.csv')
+        # the packaged files only change with the installation
+        return paths, [(os.path.getsize(p), os.path.getmtime(p)) for p in paths]
+    if datahost == 'figshare':
+        species = 'zebrafish' if species == 'zerafish' else species
+        if species not in _FIGSHARE:
+            raise ValueError("species type: {} is not supported currently. Please have a check.".format(species))
+        return _FIGSHARE[species], list(_FIGSHARE[species])
+    raise ValueError("datahost: {} is not supported, use 'builtin' or 'figshare'.".format(datahost))
+
+
+def _read_cache(filename, key):
+    try:
+        with open(filename, 'rb') as f:
+            cached = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return cached if cached.get('key') == key else None
+
+
+def _write_cache(filename, cached):
+    # the disk cache is optional, e.g. on a read-only home directory
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _load_lr_db(species, datahost, cache_dir):
+    (inter_src, comp_src), key = _sources(species, datahost)
+    filename = None if cache_dir is None else \
+        os.path.join(cache_dir, '%s-%s.pkl' % (_PACKAGE_PREFIX.get(species, species), datahost))
+    cached = None if filename is None else _read_cache(filename, key)
+    if cached is None:
+        cached = {'key': key,
+                  'geneInter': pd.read_csv(inter_src, header=0, index_col=0),
+                  'comp': pd.read_csv(comp_src, header=0, index_col=0)}
+        if filename is not None:
+            _write_cache(filename, cached)
+    return cached['geneInter'], cached['comp']
+
+
+def load_lr_db(species, datahost='builtin', cache_dir=CACHE_DIR):
+    """
+    Load the CellChatDB interaction and complex tables.
+    The tables are parsed once per process and kept as a binary copy in cache_dir, which is checked
+    against the source files, so later calls neither parse csv nor need network access.
+    :param species: 'human', 'mouse' or 'zebrafish'
+    :param datahost: 'builtin' (or 'package') for the tables shipped in spatialdm/datasets/LR_data, \
+    'figshare' to download them (once, if cache_dir is set)
+    :param cache_dir: directory of the disk cache, None to only cache in memory
+    :return: geneInter (interactions) and comp (complexes) dataframes, copies that can be modified
+    """
+    geneInter, comp = _load_lr_db(species, datahost, cache_dir)
+    return geneInter.copy(), comp.copy()
+
+
+def _flatten(subunits):
+    """CSR offsets and the flat gene array of a sequence of gene arrays."""
+    subunits = [np.asarray(x, dtype=object) for x in subunits]
+    indptr = np.zeros(len(subunits) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in subunits], out=indptr[1:])
+    return indptr, np.concatenate(subunits + [np.array([], dtype=object)]).astype(str)
+
+
+class LRIndex:
+    """Compiled ligand / receptor subunits of a list of pairs.
+
+    Subunit genes are integer codes into one gene-symbol index (genes), stored CSR-style: the subunits
+    of the ligand of pair i are genes[ligand_indices[ligand_indptr[i]:ligand_indptr[i + 1]]], in subunit
+    order. The annotation of every pair is an integer code into annotations. All attributes are plain
+    arrays, so an index is kept with the results in adata.uns['lr_index'] (see to_dict / lr_index).
+
+    :param pairs: pair names
+    :param genes: gene symbols the subunit codes refer to
+    :param ligand_indptr: (n_pairs + 1,) offsets into ligand_indices
+    :param ligand_indices: subunit codes of all ligands
+    :param receptor_indptr: (n_pairs + 1,) offsets into receptor_indices
+    :param receptor_indices: subunit codes of all receptors
+    :param annotation_codes: (n_pairs,) codes into annotations
+    :param annotations: annotation names, e.g. 'Secreted Signaling'
+    """
+    _FIELDS = ['pairs', 'genes', 'ligand_indptr', 'ligand_indices', 'receptor_indptr', 'receptor_indices',
+               'annotation_codes', 'annotations']
+
+    def __init__(self, pairs, genes, ligand_indptr, ligand_indices, receptor_indptr, receptor_indices,
+                 annotation_codes, annotations):
+        self.pairs = pd.Index(np.asarray(pairs, dtype=object))
+        self.genes = pd.Index(np.asarray(genes, dtype=object))
+        self.ligand_indptr = np.asarray(ligand_indptr, dtype=np.int64)
+        self.ligand_indices = np.asarray(ligand_indices, dtype=np.int32)
+        self.receptor_indptr = np.asarray(receptor_indptr, dtype=np.int64)
+        self.receptor_indices = np.asarray(receptor_indices, dtype=np.int32)
+        self.annotation_codes = np.asarray(annotation_codes, dtype=np.int8)
+        self.annotations = pd.Index(np.asarray(annotations, dtype=object))
+
+    @classmethod
+    def from_subunits(cls, pairs, ligand, receptor, annotation):
+        """
+        :param pairs: pair names
+        :param ligand: gene array (subunits) of the ligand of every pair
+        :param receptor: gene array (subunits) of the receptor of every pair
+        :param annotation: annotation of every pair
+        """
+        ligand_indptr, ligand_genes = _flatten(ligand)
+        receptor_indptr, receptor_genes = _flatten(receptor)
+        genes, codes = np.unique(np.concatenate((ligand_genes, receptor_genes)), return_inverse=True)
+        annotation = pd.Categorical(np.asarray(annotation, dtype=object))
+        return cls(pairs, genes, ligand_indptr, codes[:len(ligand_genes)], receptor_indptr,
+                   codes[len(ligand_genes):], annotation.codes, annotation.categories)
+
+    @classmethod
+    def from_tables(cls, ligand, receptor, annotation):
+        """
+        :param ligand: uns['ligand'] table, one row of subunits (padded with NaN / None / 'NA') per pair
+        :param receptor: uns['receptor'] table, in the same order
+        :param annotation: annotation of every pair
+        """
+        def rows(table):
+            values = table.values.astype(object)
+            keep = ~pd.isna(values) & (values != 'NA')
+            return [v[k] for v, k in zip(values, keep)]
+        return cls.from_subunits(ligand.index, rows(ligand), rows(receptor), annotation)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(*[d[k] for k in cls._FIELDS])
+
+    def to_dict(self):
+        """Plain arrays, e.g. to keep the index in adata.uns and write it with the results"""
+        return {k: np.asarray(getattr(self, k)) if k not in ['pairs', 'genes', 'annotations']
+                else np.asarray(getattr(self, k), dtype=object).astype(str).astype(object) for k in self._FIELDS}
+
+    @classmethod
+    def concat(cls, indices):
+        """Union of several indices, keeping the first occurrence of every pair"""
+        ligand, receptor, annotation, pairs = [], [], [], []
+        for index in indices:
+            new = ~index.pairs.isin(pairs) & ~index.pairs.duplicated()
+            pairs.extend(index.pairs[new])
+            ligand.extend(index.subunits('ligand', labels=False)[new])
+            receptor.extend(index.subunits('receptor', labels=False)[new])
+            annotation.extend(index.annotation[new])
+        return cls.from_subunits(pairs, ligand, receptor, annotation)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    @property
+    def annotation(self):
+        """Annotation of every pair, as a pd.Categorical"""
+        return pd.Categorical.from_codes(self.annotation_codes, categories=self.annotations)
+
+    @property
+    def secreted(self):
+        """Boolean mask of the 'Secreted Signaling' (long range) pairs; the others use the nearest neighbors"""
+        return np.asarray(self.annotation == 'Secreted Signaling')
+
+    def _side(self, side):
+        if side == 'ligand':
+            return self.ligand_indptr, self.ligand_indices
+        return self.receptor_indptr, self.receptor_indices
+
+    def subunits(self, side, labels=True):
+        """
+        Subunit gene arrays of every ligand or receptor.
+        :param side: 'ligand' or 'receptor'
+        :param labels: index the arrays by the '_'-joined genes (the complex labels of the aggregate cache) \
+        instead of by pair
+        :return: pd.Series of gene arrays
+        """
+        indptr, indices = self._side(side)
+        genes = np.split(self.genes.values[indices], indptr[1:-1]) if len(self) else []
+        return pd.Series(genes, index=['_'.join(x) for x in genes] if labels else self.pairs, dtype=object)
+
+    def pair_genes(self, pair, side):
+        """Subunit genes of the ligand or receptor of one pair"""
+        indptr, indices = self._side(side)
+        i = self.pairs.get_loc(pair)
+        return self.genes.values[indices[indptr[i]:indptr[i + 1]]]
+
+    def gene_positions(self, var_names):
+        """Position of every gene of the index in var_names, -1 if absent"""
+        return pd.Index(var_names).get_indexer(self.genes)
+
+    def subset(self, pairs):
+        """
+        Index of some of the pairs, in the given order.
+        :param pairs: pair names, or a boolean mask over the pairs
+        """
+        pairs = np.asarray(pairs)
+        if pairs.dtype == bool:
+            pos = np.flatnonzero(pairs)
+        else:
+            pos = self.pairs.get_indexer(pairs)
+            if (pos < 0).any():
+                raise KeyError("pairs not in the LR index: {}".format(list(pairs[pos < 0][:5])))
+        subsets = []
+        for indptr, indices in [self._side('ligand'), self._side('receptor')]:
+            n = indptr[pos + 1] - indptr[pos]
+            new_indptr = np.zeros(len(pos) + 1, dtype=np.int64)
+            np.cumsum(n, out=new_indptr[1:])
+            take = np.repeat(indptr[pos] - new_indptr[:-1], n) + np.arange(new_indptr[-1])
+            subsets += [new_indptr, indices[take]]
+        return LRIndex(self.pairs[pos], self.genes, *subsets, self.annotation_codes[pos], self.annotations)
+
+    def to_tables(self):
+        """Ragged uns['ligand'] / uns['receptor'] tables, Ligand0, Ligand1, ... padded with None"""
+        tables = []
+        for side, prefix in [('ligand', 'Ligand'), ('receptor', 'Receptor')]:
+            indptr, indices = self._side(side)
+            n = np.diff(indptr)
+            table = np.full((len(self), n.max(initial=0)), None, dtype=object)
+            table[np.repeat(np.arange(len(self)), n), np.arange(indptr[-1]) - np.repeat(indptr[:-1], n)] = \
+                self.genes.values[indices]
+            tables.append(pd.DataFrame(table, index=self.pairs,
+                                       columns=[prefix + str(i) for i in range(table.shape[1])]))
+        return tables
+
+
+def lr_index(adata):
+    """
+    LRIndex of the pairs in adata.uns['ligand'] / adata.uns['receptor'], as kept in adata.uns['lr_index'].
+    It is compiled from the tables (and stored) if missing or out of date, e.g. for results of older versions.
+    """
+    d = adata.uns.get('lr_index')
+    pairs = adata.uns['ligand'].index
+    if d is not None and len(d['pairs']) == len(pairs) and (np.asarray(d['pairs']) == np.asarray(pairs)).all():
+        return LRIndex.from_dict(d)
+    index = LRIndex.from_tables(adata.uns['ligand'], adata.uns['receptor'],
+                                adata.uns['geneInter']['annotation'].reindex(pairs).values)
+    adata.uns['lr_index'] = index.to_dict()
+    return index
@@ -1,182 +1,211 @@
 import os
 import pandas as pd
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
-from statsmodels.stats.multitest import fdrcorrection
 from scipy import spatial
+from scipy.sparse import csr_matrix
 # import json
 from threadpoolctl import threadpool_limits
 from .utils import *
-from itertools import zip_longest
+from .fdr import *
+from .store import *
+from .lr_db import load_lr_db, LRIndex, lr_index
+from .utils import _empty_store
 import anndata as ann
 
 
-def weight_matrix(adata, l, cutoff=None, n_neighbors=None, n_nearest_neighbors=6, single_cell=False):
+def _rbf_kernel(d, l):
+    """exp(-d^2 / (2 l^2)), in place"""
+    np.square(d, out=d)
+    d *= -1 / (2 * l ** 2)
+    np.exp(d, out=d)
+
+
+def _exponential_kernel(d, l):
+    """exp(-d / l), in place"""
+    d *= -1 / l
+    np.exp(d, out=d)
+
+
+def _inverse_distance_kernel(d, l):
+    """l / (l + d), in place"""
+    d /= l
+    d += 1
+    np.reciprocal(d, out=d)
+
+
+def _step_kernel(d, l):
+    """1 within distance l, 0 beyond, in place"""
+    np.less_equal(d, l, out=d, casting='unsafe')
+
+
+# kernel: (in-place transform of distances, radius at which the weight drops to cutoff)
+_KERNELS = {
+    'rbf': (_rbf_kernel, lambda l, cutoff: l * np.sqrt(-2 * np.log(cutoff))),
+    'exponential': (_exponential_kernel, lambda l, cutoff: -l * np.log(cutoff)),
+    'inverse_distance': (_inverse_distance_kernel, lambda l, cutoff: l * (1 / cutoff - 1)),
+    'step': (_step_kernel, lambda l, cutoff: l),
+}
+
+
+def _radius_pairs(tree, X_loc, radius, dtype=np.float32):
+    """All (row, col, distance) pairs within `radius`, both directions, self excluded"""
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    dist = np.sqrt(((X_loc[pairs[:, 0]] - X_loc[pairs[:, 1]]) ** 2).sum(1)).astype(dtype)
+    rows = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    cols = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    return rows, cols, np.concatenate((dist, dist))
+
+
+def _knn_pairs(tree, X_loc, k, rows=None, dtype=np.float32):
+    """(row, col, distance) of the k nearest neighbors (self counted, but not returned)"""
+    if rows is None:
+        rows = np.arange(X_loc.shape[0])
+    k = min(k, X_loc.shape[0])
+    dist, idx = tree.query(X_loc[rows], k=k)
+    row_idx = np.repeat(rows, k)
+    idx, dist = idx.reshape(-1), dist.reshape(-1).astype(dtype)
+    keep = idx != row_idx
+    return row_idx[keep], idx[keep], dist[keep]
+
+
+def _nearest_pairs(rows, cols, dist, k, tree, X_loc):
+    """Keep the k-1 closest neighbors per spot out of a (row, col, distance) graph.
+    Spots with fewer neighbors in the graph are completed by a kNN query on those spots only.
+    """
+    N = X_loc.shape[0]
+    order = np.lexsort((dist, rows))
+    counts = np.bincount(rows, minlength=N)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(len(order)) - starts[rows[order]]
+    keep = order[rank < k - 1]
+    rows, cols, dist = rows[keep], cols[keep], dist[keep]
+
+    short = np.where(counts < min(k, N) - 1)[0]
+    if len(short) > 0:
+        fill = _knn_pairs(tree, X_loc, k, rows=short, dtype=dist.dtype)
+        keep = ~np.isin(rows, short)
+        rows, cols, dist = [np.concatenate((x[keep], y)) for x, y in zip((rows, cols, dist), fill)]
+    return rows, cols, dist
+
+
+def _kernel_graph(rows, cols, dist, N, l, kernel, self_loops):
+    """Build the CSR weight graph and convert its distances to weights in place.
+    Self loops are inserted as explicit zero distances, so no diagonal edit is needed afterwards.
+    """
+    if self_loops:
+        diag = np.arange(N)
+        rows, cols = np.concatenate((rows, diag)), np.concatenate((cols, diag))
+        dist = np.concatenate((dist, np.zeros(N, dtype=dist.dtype)))
+    W = csr_matrix((dist, (rows, cols)), shape=(N, N))
+    _KERNELS[kernel][0](W.data, l)
+    W.eliminate_zeros()
+    W.data *= N / W.data.sum()
+    return W
+
+
+def weight_matrix(adata, l, cutoff=None, n_neighbors=None, n_nearest_neighbors=6, single_cell=False,
+                  kernel='rbf', dtype=np.float32):
     """
     compute weight matrix based on radial basis kernel.
     cutoff & n_neighbors are two alternative options to restrict signaling range.
     :param l: radial basis kernel parameter, need to be customized for optimal weight gradient and \
     to restrain the range of signaling before downstream processing.
     :param cutoff: (for secreted signaling) minimum weight to be kept from the rbf weight matrix. \
-    Weight below cutoff will be made zero
-    :param n_neighbors: (for secreted signaling) number of neighbors per spot from the rbf weight matrix.
+    Weight below cutoff will be made zero. The radius at which the kernel drops to cutoff is \
+    queried directly, so only in-range pairs are ever allocated.
+    :param n_neighbors: (for secreted signaling) number of neighbors per spot from the rbf weight matrix. \
+    Only used when cutoff is not given.
     :param n_nearest_neighbors: (for adjacent signaling) number of neighbors per spot from the rbf \
     weight matrix.
     Non-neighbors will be made 0
     :param single_cell: if single cell resolution, diagonal will be made 0.
+    :param kernel: distance-to-weight kernel, one of 'rbf' (default), 'exponential', \
+    'inverse_distance' or 'step' (weight 1 within distance l).
+    :param dtype: floating point precision of the weight matrices, default to np.float32.
     :return: secreted signaling weight matrix: adata.obsp['weight'], \
             and adjacent signaling weight matrix: adata.obsp['nearest_neighbors']
     """
-    def _Euclidean_to_RBF(X, l, singlecell=single_cell):
-        """Convert Euclidean distance to RBF distance"""
-        from scipy.sparse import issparse
-        if issparse:
-            rbf_d = X
-            rbf_d[X.nonzero()] = np.exp(-X[X.nonzero()].A**2 / (2 * l ** 2))
-        else:
-            rbf_d = np.exp(- X**2 / (2 * l ** 2))
-        
-        # At single-cell resolution, no within-spot communications
-        if singlecell:
-            np.fill_diagonal(rbf_d, 0)
-        else:
-            rbf_d.setdiag(np.exp(-X.diagonal()**2 / (2 * l ** 2)))
+    if kernel not in _KERNELS:
+        raise ValueError("Only one of {} is supported".format(list(_KERNELS)))
 
-        return rbf_d
-    
     adata.uns['single_cell'] = single_cell
     if isinstance(adata.obsm['spatial'], pd.DataFrame):
         X_loc = adata.obsm['spatial'].values
     else:
         X_loc = adata.obsm['spatial']
+    X_loc = np.asarray(X_loc, dtype=np.float64)
+    N = X_loc.shape[0]
 
-    if n_neighbors is None:
-        n_neighbors = n_nearest_neighbors * 31
-
-    ## large neighborhood for W (5 layers)
-    nnbrs = NearestNeighbors(
-        n_neighbors=n_neighbors,
-        algorithm='ball_tree', 
-        metric='euclidean'
-    ).fit(X_loc)
-    nbr_d = nnbrs.kneighbors_graph(X_loc, mode='distance')
-    rbf_d = _Euclidean_to_RBF(nbr_d, l, single_cell)
-
-    ## small neighborhood for RBF
-    nnbrs0 = NearestNeighbors(
-        n_neighbors=n_nearest_neighbors, 
-        algorithm='ball_tree', 
-        metric='euclidean'
-    ).fit(X_loc)
-    nbr_d0 = nnbrs0.kneighbors_graph(X_loc, mode='distance')
-    rbf_d0 = _Euclidean_to_RBF(nbr_d0, l, single_cell)
-
-    # NOTE: add more info about cutoff, n_neighbors and n_nearest_neighbors
+    # one KD-tree serves both the large (W) and the small (nearest neighbors) graph
+    tree = spatial.cKDTree(X_loc)
     if cutoff:
-        # not efficient
-        # rbf_d[rbf_d < cutoff] = 0
-        
-        # more efficient: 
-        # https://seanlaw.github.io/2019/02/27/set-values-in-sparse-matrix/
-        nonzero_mask = np.array(rbf_d[rbf_d.nonzero()] < cutoff)[0]
-        rows = rbf_d.nonzero()[0][nonzero_mask]
-        cols = rbf_d.nonzero()[1][nonzero_mask]
-        rbf_d[rows, cols] = 0
-
-    # elif n_neighbors:
-    #     nbrs = NearestNeighbors(n_neighbors=n_neighbors, algorithm='ball_tree').fit(rbf_d)
-    #     knn = nbrs.kneighbors_graph(rbf_d).toarray()
-    #     rbf_d = rbf_d * knn
-
-    adata.obsp['weight'] = rbf_d * adata.shape[0] / rbf_d.sum()
-    adata.obsp['nearest_neighbors'] = rbf_d0 * adata.shape[0] / rbf_d0.sum()
+        radius = _KERNELS[kernel][1](l, cutoff)
+        nbr_d = _radius_pairs(tree, X_loc, radius, dtype)
+        nbr_d0 = _nearest_pairs(*nbr_d, n_nearest_neighbors, tree, X_loc)
+    else:
+        if n_neighbors is None:
+            n_neighbors = n_nearest_neighbors * 31
+        nbr_d = _knn_pairs(tree, X_loc, max(n_neighbors, n_nearest_neighbors), dtype=dtype)
+        nbr_d0 = _nearest_pairs(*nbr_d, n_nearest_neighbors, tree, X_loc)
+        if n_neighbors < n_nearest_neighbors:
+            nbr_d = _nearest_pairs(*nbr_d, n_neighbors, tree, X_loc)
+
+    # At single-cell resolution, no within-spot communications
+    adata.obsp['weight'] = _kernel_graph(*nbr_d, N, l, kernel, not single_cell)
+    adata.obsp['nearest_neighbors'] = _kernel_graph(*nbr_d0, N, l, kernel, not single_cell)
+    # moments and cell type interactions of the previous graphs
+    adata.uns.pop('weight_moments', None)
+    adata.uns.pop('celltype_interactions', None)
     return
 
 def extract_lr(adata, species, mean='algebra', min_cell=0, datahost='builtin'):
     """
     find overlapping LRs from CellChatDB
-    :param adata: AnnData object
+    :param adata: AnnData object. Can be backed (read_h5ad(..., backed='r')) for data larger than memory: \
+    only the ligand/receptor gene columns are read, chunk-wise, here and in the global/local selection.
     :param species: support 'human', 'mouse' and 'zebrafish'
     :param mean: 'algebra' (default) or 'geometric'
     :param min_cell: for each selected pair, the spots expressing ligand or receptor should be larger than the min,
     respectively.
-    :param datahost: the host of the ligand-receptor data. 'builtin' for package built-in otherwise from figshare
+    :param datahost: the host of the ligand-receptor data. 'builtin' (or 'package') for package built-in, \
+    'figshare' to download it. Both are cached in memory and on disk, see load_lr_db.
     :return: ligand, receptor, geneInter (containing comprehensive info from CellChatDB) dataframes \
             in adata.uns
     """
-    if mean=='geometric':
-        from scipy.stats.mstats import gmean
     adata.uns['mean'] = mean
 
-    if datahost == 'package':
-        if species in ['mouse', 'human', 'zerafish']:
-            datapath = './datasets/LR_data/%s-' %(species)
-        else:
-            raise ValueError("species type: {} is not supported currently. Please have a check.".format(species))
-        
-        import pkg_resources
-        stream1 = pkg_resources.resource_stream(__name__, datapath + 'interaction_input_CellChatDB.csv.gz')
-        geneInter = pd.read_csv(stream1, index_col=0, compression='gzip')
-
-        stream2 = pkg_resources.resource_stream(__name__, datapath + 'complex_input_CellChatDB.csv')
-        comp = pd.read_csv(stream2, header=0, index_col=0)
-    else:
-        if species == 'mouse':
-            geneInter = pd.read_csv('https://figshare.com/ndownloader/files/36638919', index_col=0)
-            comp = pd.read_csv('https://figshare.com/ndownloader/files/36638916', header=0, index_col=0)
-        elif species == 'human':
-            geneInter = pd.read_csv('https://figshare.com/ndownloader/files/36638943', header=0, index_col=0)
-            comp = pd.read_csv('https://figshare.com/ndownloader/files/36638940', header=0, index_col=0)
-        elif species == 'zebrafish':
-            geneInter = pd.read_csv('https://figshare.com/ndownloader/files/38756022', header=0, index_col=0)
-            comp = pd.read_csv('https://figshare.com/ndownloader/files/38756019', header=0, index_col=0)
-        else:
-            raise ValueError("species type: {} is not supported currently. Please have a check.".format(species))
-        
+    geneInter, comp = load_lr_db(species, datahost)
+
     geneInter = geneInter.sort_values('annotation')
-    ligand = geneInter.ligand.values
-    receptor = geneInter.receptor.values
-    geneInter.pop('ligand')
-    geneInter.pop('receptor')
-
-    ## NOTE: the following for loop needs speed up
-    t = []
-    for i in range(len(ligand)):
-        for n in [ligand, receptor]:
-            l = n[i]
-            if l in comp.index:
-                n[i] = comp.loc[l].dropna().values[pd.Series \
-                    (comp.loc[l].dropna().values).isin(adata.var_names)]
-            else:
-                n[i] = pd.Series(l).values[pd.Series(l).isin(adata.var_names)]
-        if (len(ligand[i]) > 0) * (len(receptor[i]) > 0):
-            if mean=='geometric':
-                meanL = gmean(adata[:, ligand[i]].X, axis=1)
-                meanR = gmean(adata[:, receptor[i]].X, axis=1)
-            else:
-                meanL = adata[:, ligand[i]].X.mean(axis=1)
-                meanR = adata[:, receptor[i]].X.mean(axis=1)
-            if (sum(meanL > 0) >= min_cell) * \
-                    (sum(meanR > 0) >= min_cell):
-                t.append(True)
-            else:
-                t.append(False)
-        else:
-            t.append(False)
+    ligand = geneInter.pop('ligand').values
+    receptor = geneInter.pop('receptor').values
+
+    # resolve each ligand / receptor (complex) once and average all of them in one product;
+    # the averages are cached in adata.obsm for the global and local selection
+    subunits = resolve_subunits(np.concatenate((ligand, receptor)), comp, adata.var_names)
+    labels = subunits.apply('_'.join)
+    expressed = subunits[subunits.apply(len) > 0]
+    expressed.index = labels[expressed.index].values
+    n_expressed = np.asarray((complex_means(adata, expressed) > 0).sum(0)).ravel()
+    n_expressed = pd.Series(n_expressed, index=expressed.index)
+    n_expressed = n_expressed[~n_expressed.index.duplicated()]
+    valid = (labels != '') & (labels.map(n_expressed).fillna(0) >= min_cell)
+    t = valid.loc[ligand].values & valid.loc[receptor].values
+
+    # subunits of the kept pairs compiled once, the ragged tables are derived from it
     ind = geneInter[t].index
-    adata.uns['ligand'] = pd.DataFrame.from_records(zip_longest(*pd.Series(ligand[t]).values)).transpose()
-    adata.uns['ligand'].columns = ['Ligand' + str(i) for i in range(adata.uns['ligand'].shape[1])]
-    adata.uns['ligand'].index = ind
-    adata.uns['receptor'] = pd.DataFrame.from_records(zip_longest(*pd.Series(receptor[t]).values)).transpose()
-    adata.uns['receptor'].columns = ['Receptor' + str(i) for i in range(adata.uns['receptor'].shape[1])]
-    adata.uns['receptor'].index = ind
+    index = LRIndex.from_subunits(ind, subunits.loc[ligand[t]].values, subunits.loc[receptor[t]].values,
+                                  geneInter.loc[ind, 'annotation'].values)
+    adata.uns['ligand'], adata.uns['receptor'] = index.to_tables()
+    adata.uns['lr_index'] = index.to_dict()
     adata.uns['num_pairs'] = len(ind)
     adata.uns['geneInter'] = geneInter.loc[ind]
     if adata.uns['num_pairs'] == 0:
         raise ValueError("No effective RL. Please have a check on input count matrix/species.")
     return
 
-def spatialdm_global(adata, n_perm=1000, specified_ind=None, method='z-score', nproc=1):
+def spatialdm_global(adata, n_perm=1000, specified_ind=None, method='z-score', nproc=1, dtype=np.float32,
+                     max_memory=1024, seed=None, keep_perm=False):
     """
         global selection. 2 alternative methods can be specified.
     :param n_perm: number of times for shuffling receptor expression for a given pair, default to 1000.
@@ -185,7 +214,18 @@ def spatialdm_global(adata, n_perm=1000, specified_ind=None, method='z-score', n
     :param method: default to 'z-score' for computation efficiency.
         Alternatively, can specify 'permutation' or 'both'.
         Two approaches should generate consistent results in general.
-    :param nproc: default to 1. Please decide based on your system.
+    :param nproc: default to 1. Number of processes the permutations are distributed over. \
+    Please decide based on your system.
+    :param dtype: precision of all intermediates (standardized L/R matrices, weights, permutation buffers \
+    and z/p arrays), default to np.float32.
+    :param max_memory: memory budget (MB) for one block of permutations, which are computed together \
+    in a single sparse-dense product, shared by all processes, and for one chunk of a backed adata.X. \
+    Default to 1024.
+    :param seed: seed for the permutations. Each permutation has its own random stream, so results \
+    are reproducible regardless of nproc. If None, drawn from np.random.
+    :param keep_perm: if True, also keep the full (n_pairs, n_perm) null in \
+    adata.uns['global_stat']['perm']['global_perm']. By default only exceedance counts and the \
+    null mean / std are kept, whatever n_perm.
     :return: 'global_res' dataframe in adata.uns containing pair info and Moran p-values
     """
     if specified_ind is None:
@@ -193,24 +233,27 @@ def spatialdm_global(adata, n_perm=1000, specified_ind=None, method='z-score', n
     else:
         adata.uns['geneInter'] = adata.uns['geneInter'].loc[specified_ind]
     total_len = len(specified_ind)
+    index = lr_index(adata).subset(specified_ind)
     adata.uns['ligand'] = adata.uns['ligand'].loc[specified_ind]#.values
     adata.uns['receptor'] = adata.uns['receptor'].loc[specified_ind]#.values
-    adata.uns['global_I'] = np.zeros(total_len)
+    adata.uns['lr_index'] = index.to_dict()
+    adata.uns['global_I'] = np.zeros(total_len, dtype=dtype)
     adata.uns['global_stat'] = {}
     if method in ['z-score', 'both']:
         adata.uns['global_stat']['z']={}
         adata.uns['global_stat']['z']['st'] = globle_st_compute(adata)
-        adata.uns['global_stat']['z']['z'] = np.zeros(total_len)
-        adata.uns['global_stat']['z']['z_p'] = np.zeros(total_len)
+        adata.uns['global_stat']['z']['z'] = np.zeros(total_len, dtype=dtype)
+        adata.uns['global_stat']['z']['z_p'] = np.zeros(total_len, dtype=dtype)
     if method in ['both', 'permutation']:
         adata.uns['global_stat']['perm']={}
-        adata.uns['global_stat']['perm']['global_perm'] = np.zeros((total_len, n_perm)).astype(np.float16)
+        adata.uns['global_stat']['perm']['n_greater'] = np.zeros(total_len, dtype=np.int64)
+        adata.uns['global_stat']['perm']['n_perm'] = n_perm
 
     if not (method in ['both', 'z-score', 'permutation']):
         raise ValueError("Only one of ['z-score', 'both', 'permutation'] is supported")
 
     with threadpool_limits(limits=nproc, user_api='blas'):
-        pair_selection_matrix(adata, n_perm, specified_ind, method)
+        pair_selection_matrix(adata, n_perm, specified_ind, method, dtype, max_memory, nproc, seed, keep_perm)
 
     adata.uns['global_res'] = pd.concat((adata.uns['ligand'], adata.uns['receptor']),axis=1)
     # adata.uns['global_res'].columns = ['Ligand1', 'Ligand2', 'Ligand3', 'Receptor1', 'Receptor2', 'Receptor3', 'Receptor4']
@@ -221,8 +264,8 @@ def spatialdm_global(adata, n_perm=1000, specified_ind=None, method='z-score', n
         adata.uns['global_res']['z'] = adata.uns['global_stat']['z']['z']
 
     if method in ['both', 'permutation']:
-        adata.uns['global_stat']['perm']['global_p'] = 1 - (adata.uns['global_I'] \
-                             > adata.uns['global_stat']['perm']['global_perm'].T).sum(axis=0) / n_perm
+        adata.uns['global_stat']['perm']['global_p'] = 1 - \
+            adata.uns['global_stat']['perm']['n_greater'].astype(dtype) / n_perm
         adata.uns['global_res']['perm_pval'] = adata.uns['global_stat']['perm']['global_p']
     return
 
@@ -242,12 +285,13 @@ def sig_pairs(adata, method='z-score', fdr=True, threshold=0.1):
     else:
         raise ValueError("Only one of ['z-score', 'permutation'] is supported")
     if fdr:
-        _p = fdrcorrection(_p)[1]
+        _p = fdr_bh(_p)
         adata.uns['global_res']['fdr'] = _p
     adata.uns['global_res']['selected'] = (_p < threshold)
 
 def spatialdm_local(adata, n_perm=1000, method='z-score', specified_ind=None,
-                    nproc=1, scale_X=True):
+                    nproc=1, scale_X=True, dtype=np.float32, max_memory=1024, seed=None, keep_perm=False,
+                    store=None):
     """
         local spot selection
     :param n_perm: number of times for shuffling neighbors partner for a given spot, default to 1000.
@@ -255,62 +299,107 @@ def spatialdm_local(adata, n_perm=1000, method='z-score', specified_ind=None,
         Alternatively, can specify 'permutation' or 'both' (recommended for spot number < 1000, multiprocesing).
     :param specified_ind: array containing queried indices in sample pair(s).
     If not specified, local selection will be done for all sig pairs
-    :param nproc: default to 1.
+    :param nproc: default to 1. Number of processes the permutations are distributed over.
+    :param dtype: precision of all intermediates and local statistics, default to np.float32.
+    :param max_memory: memory budget (MB) for one block of pairs, for one block of permutations per call \
+    (shared by all processes), and for one chunk of a backed adata.raw. Pairs are processed in blocks \
+    sized to it, so memory beyond the results does not grow with the number of pairs. Default to 1024.
+    :param seed: seed for the permutations, reproducible regardless of nproc. If None, drawn from np.random.
+    :param keep_perm: if True, also keep the full (n_pairs, n_perm, n_spots) nulls 'local_permI' and \
+    'local_permI_R' in adata.uns['local_stat']. By default permutations are streamed into per pair x spot \
+    exceedance counts, so memory does not depend on n_perm. The counts are kept in \
+    adata.uns['local_stat']['local_perm_n'] (with 'n_perm').
+    :param store: optional directory. If given, the (n_spots, n_pairs) / (n_pairs, n_spots) results \
+    local_I, local_I_R, local_z, local_z_p, local_perm_p and local_perm_n are memory-mapped .npy files in it, \
+    written block by block, instead of in-memory arrays. sig_spots then writes local_fdr there too.
     :return: 'local_stat' & 'local_z_p' and/or 'local_perm_p' in adata.uns.
     """
     adata.uns['local_stat'] = {}
-    if (int(n_perm / nproc) != (n_perm / nproc)):
-        raise ValueError("n_perm should be divisible by nproc")
+    if store is not None:
+        # sig_spots writes local_fdr next to the p-values
+        adata.uns['local_stat']['store'] = store
     if type(specified_ind) == type(None):
         specified_ind = adata.uns['global_res'][
             adata.uns['global_res']['selected']].index  # default to global selected pairs
     # total_len = len(specified_ind)
-    ligand = adata.uns['ligand'].loc[specified_ind]
-    receptor = adata.uns['receptor'].loc[specified_ind]
-    ind = ligand.index
-    adata.uns['local_stat']['local_I'] = np.zeros((adata.shape[0], len(ind)))
-    adata.uns['local_stat']['local_I_R'] = np.zeros((adata.shape[0], len(ind)))
+    index = lr_index(adata).subset(specified_ind)
+    ind = index.pairs
     N = adata.shape[0]
-    if method in ['both', 'permutation']:
-        adata.uns['local_stat']['local_permI'] = np.zeros((len(ind), n_perm, N))
-        adata.uns['local_stat']['local_permI_R'] = np.zeros((len(ind), n_perm, N))
+    adata.uns['local_stat']['local_I'] = _empty_store((N, len(ind)), dtype, store, 'local_I')
+    adata.uns['local_stat']['local_I_R'] = _empty_store((N, len(ind)), dtype, store, 'local_I_R')
+    if method in ['both', 'permutation'] and keep_perm:
+        adata.uns['local_stat']['local_permI'] = np.zeros((len(ind), n_perm, N), dtype=dtype)
+        adata.uns['local_stat']['local_permI_R'] = np.zeros((len(ind), n_perm, N), dtype=dtype)
     if method in ['both', 'z-score']:
-        adata.uns['local_z'] = np.zeros((len(ind), adata.shape[0]))
-        adata.uns['local_z_p'] = np.zeros((len(ind), adata.shape[0]))
+        adata.uns['local_z'] = _empty_store((len(ind), N), dtype, store, 'local_z')
+        adata.uns['local_z_p'] = _empty_store((len(ind), N), dtype, store, 'local_z_p')
 
     ## different approaches
     with threadpool_limits(limits=nproc, user_api='blas'):
-        spot_selection_matrix(adata, ligand, receptor, ind, n_perm, method, scale_X)
+        spot_selection_matrix(adata, index, ind, n_perm, method, scale_X, dtype,
+                              max_memory, nproc, seed, keep_perm, store)
 
 
-def sig_spots(adata, method='z-score', fdr=True, threshold=0.1):
+def sig_spots(adata, method='z-score', fdr=True, threshold=0.1, sparse=False, fdr_method='exact'):
     """
         pick significantly co-expressing spots
     :param method: one of the methods from spatialdm_local, default to 'z-score'.
     :param fdr: True or False, default to True
     :param threshold: p-value or fdr cutoff to retain significant pairs. Default to 0.1.
-    :return:  1) 'selected_spots' in adata.uns: a binary frame of which spots being selected for each pair;
+    :param sparse: if True, store 'selected_spots' as a boolean scipy CSR matrix (pairs x spots, \
+    spots in the order of adata.obs_names) instead of a dense frame. Default to False.
+    :param fdr_method: 'exact' (default) Benjamini-Hochberg, or 'bucketed' for a two-pass chunked version \
+    that never sorts the p-values and is conservative within a relative 2^-15 (see fdr.fdr_bh_chunked).
+    :return:  1) 'selected_spots' in adata.uns: a binary frame (or CSR matrix) of which spots being selected \
+    for each pair;
      2) 'n_spots' in adata.uns['local_stat']: number of selected spots for each pair.
+     3) 'pairs' in adata.uns['local_stat']: the pairs (rows) of 'selected_spots'.
+     4) 'local_fdr' in adata.uns['local_stat'] if fdr: the adjusted p-values. 'local_z_p' / 'local_perm_p' \
+    are not modified.
     """
     if method == 'z-score':
         _p = adata.uns['local_z_p']
     if method == 'permutation':
         _p = adata.uns['local_perm_p']
     if fdr:
-        _fdr = fdrcorrection(np.hstack(_p.values))[1].reshape(_p.shape)
-        _p.loc[:,:] = _fdr
+        # adjusted values in their own array, the raw p-values are kept
+        # written to a preallocated (memory-mapped, with a store) array, the chunked version then never
+        # holds all pairs x spots values in memory
+        _fdr = _empty_store(_p.shape, _p.values.dtype if _p.values.dtype.kind == 'f' else np.float64,
+                            adata.uns['local_stat'].get('store'), 'local_fdr')
+        if fdr_method == 'exact':
+            fdr_bh(_p.values, out=_fdr)
+        else:
+            fdr_bh_chunked(_p.values, out=_fdr)
+        _p = pd.DataFrame(_fdr, index=_p.index, columns=_p.columns, copy=False)
         adata.uns['local_stat']['local_fdr'] = _p
-    adata.uns['selected_spots'] = (_p < threshold)
-    adata.uns['local_stat']['n_spots'] = adata.uns['selected_spots'].sum(1)
+    else:
+        adata.uns['local_stat'].pop('local_fdr', None)
+    if sparse:
+        adata.uns['selected_spots'] = sparse_selection(_p.values, threshold)
+        n_spots = np.diff(adata.uns['selected_spots'].indptr)
+    else:
+        adata.uns['selected_spots'] = (_p < threshold)
+        n_spots = adata.uns['selected_spots'].values.sum(1)
+    adata.uns['local_stat']['n_spots'] = pd.Series(n_spots, index=_p.index, dtype=np.int64)
+    adata.uns['local_stat']['pairs'] = np.asarray(_p.index)
     adata.uns['local_stat']['local_method'] = method
     return
 
+def _unmap(d):
+    """Plain ndarray views of the memory-mapped results of spatialdm_local(store=...), which anndata cannot write"""
+    for k, x in d.items():
+        if isinstance(x, np.memmap):
+            d[k] = np.asarray(x)
+
 def drop_uns_na(adata, global_stat=False, local_stat=False):
     adata.uns['geneInter'] = adata.uns['geneInter'].fillna('NA')
     adata.uns['global_res'] = adata.uns['global_res'].fillna('NA')
     adata.uns['ligand'] = adata.uns['ligand'].fillna('NA')
     adata.uns['receptor'] = adata.uns['receptor'].fillna('NA')
     adata.uns['local_stat']['n_spots'] = pd.DataFrame(adata.uns['local_stat']['n_spots'], columns=['n_spots'])
+    _unmap(adata.uns)
+    _unmap(adata.uns['local_stat'])
     if global_stat and ('global_stat' in adata.uns.keys()):
         adata.uns.pop('global_stat')
     if local_stat and ('local_stat' in adata.uns.keys()):
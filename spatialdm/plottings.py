@@ -7,6 +7,8 @@ import scipy.stats as stats
 import seaborn as sns
 #from utils import compute_pathway
 from .utils import *
+from .utils import _local_pairs
+from .lr_db import lr_index
 import holoviews as hv
 from holoviews import opts, dim
 from bokeh.io import output_file, show
@@ -53,32 +55,33 @@ def generate_colormap(number_of_distinct_colors, number_of_shades = 7):
     initial_cm = np.array(['#%02x%02x%02x' % tuple(initial_cm[i]) for i in range(len(initial_cm))])
     return initial_cm
 
-def ligand_ct(adata, pair):
-    ct_L = (
-        adata.uns['local_stat']['local_I'][:,adata.uns['selected_spots'].index==pair] * 
-        adata.obsm['celltypes']
-    )
+def ligand_ct(adata, pair, results=None):
+    if results is None:
+        results = LocalResults(adata)
+    ct_L = adata.obsm['celltypes'].mul(results.local_I(pair), axis=0)
     return ct_L
 
-def receptor_ct(adata, pair):
-    ct_R = (
-        adata.uns['local_stat']['local_I_R'][:,adata.uns['selected_spots'].index==pair] *
-        adata.obsm['celltypes']
-    )
+def receptor_ct(adata, pair, results=None):
+    if results is None:
+        results = LocalResults(adata)
+    ct_R = adata.obsm['celltypes'].mul(results.local_I_R(pair), axis=0)
     return ct_R
 
-def chord_celltype(adata, pairs, color_dic=None, title=None, min_quantile=0.5, ncol=1, save=None):
+def chord_celltype(adata, pairs, color_dic=None, title=None, min_quantile=0.5, ncol=1, save=None, results=None):
     """
     Plot aggregated cell type weights given a list of interaction pairs
     :param adata: Anndata object
-    :param pairs: List of interactions. Must be consistent with adata.uns['selected_spots'].index
+    :param pairs: List of interactions. Must be consistent with the pairs of adata.uns['selected_spots']
     :param color_dic: dict containing specified colors for each cell type
     :param title: default to names provided in pairs
     :param min_quantile: Minimum edge numbers (in quantile) to show in the plot, default to 0.5.
     :param ncol: number of columns if more than one pair will be plotted.
     :param save: 'svg' or 'png' or None
+    :param results: LocalResults to read local I from, default to LocalResults(adata)
     :return: Chord diagram showing enriched cell types. Edge color indicates source cell types.
     """
+    if results is None:
+        results = LocalResults(adata)
 
     if color_dic is None:
         # adata.obsm['celltypes'] = adata.obs[adata.obs.columns]
@@ -91,27 +94,18 @@ def chord_celltype(adata, pairs, color_dic=None, title=None, min_quantile=0.5, n
 
     if type(min_quantile) is float:
         min_quantile = np.repeat(min_quantile, len(pairs))
+    # [source, target, pair] cell type communication, cached in adata.uns['celltype_interactions']
+    tensor = celltype_interactions(adata, pairs, results)
+    cts = adata.obsm['celltypes'].columns
     for i, pair in enumerate(pairs):
         if title is None:
             t = pair
-        type_interaction = adata.uns['geneInter'].loc[pair, 'annotation']
-        if type_interaction == 'Secreted Signaling':
-            w = adata.obsp['weight']
-        else:
-            w = adata.obsp['nearest_neighbors']
-
-        ct_L = ligand_ct(adata, pair)
-        ct_R = receptor_ct(adata, pair)
 
-        sparse_ct_sum = [[(csc_matrix(w).multiply(ct_L[n1].values).T.multiply(ct_R[n2].values)).sum() \
-                          for n1 in ct_L.columns] for n2 in ct_R.columns]
-        sparse_ct_sum = np.array(sparse_ct_sum)
+        Links = pd.DataFrame({'source': np.tile(cts, len(cts)),
+                              'target': np.repeat(cts, len(cts)),
+                              'value': tensor[:, :, i].T.reshape(-1)})
 
-        Links = pd.DataFrame({'source': np.tile(ct_L.columns, ct_R.shape[1]),
-                              'target': np.repeat(ct_R.columns, ct_L.shape[1]),
-                              'value': sparse_ct_sum.reshape(1, -1)[0]})
-
-        Nodes = pd.DataFrame({'name': ct_L.columns})
+        Nodes = pd.DataFrame({'name': cts})
         Nodes.index = Nodes.name.values
         nodes = hv.Dataset(Nodes, 'index')
 
@@ -157,9 +151,8 @@ def chord_LR(adata, senders, receivers, color_dic=None,
         :return: Chord diagram showing enriched interactions. Edge color indicates ligand.
     """
     if color_dic is None:
-        subgeneInter = adata.uns['geneInter'].loc[adata.uns['selected_spots'].index]
-        type_interaction = subgeneInter.annotation
-        n_short_lri = (type_interaction!='Secreted Signaling').sum()
+        subgeneInter = adata.uns['geneInter'].loc[_local_pairs(adata)]
+        n_short_lri = (~lr_index(adata).subset(_local_pairs(adata)).secreted).sum()
         ligand_all = subgeneInter.interaction_name_2.str.split('-').str[0]
         receptor_all = subgeneInter.interaction_name_2.str.split('-').str[1]
         genes_all = np.hstack((ligand_all, receptor_all))
@@ -231,7 +224,7 @@ def chord_celltype_allpairs(adata, color_dic=None,
     """
        Plot aggregated cell type weights for all pairs in adata.uns['selected_spots']
        :param adata: Anndata object
-       :param pairs: List of interactions. Must be consistent with adata.uns['selected_spots'].index
+       :param pairs: List of interactions. Must be consistent with the pairs of adata.uns['selected_spots']
        :param color_dic: dict containing specified colors for each cell type
        :param title: default to names provided in pairs
        :param min_quantile: Minimum edge numbers (in quantile) to show in the plot, default to 0.5.
@@ -241,25 +234,24 @@ def chord_celltype_allpairs(adata, color_dic=None,
        one for secreted signaling, and the other for the aggregated.
        """
 
+    # cell types of the tensor, as in chord_celltype
+    ct = adata.obsm['celltypes'].columns.sort_values()
+    l = len(ct)
     if color_dic is None:
-        ct = adata.obs.columns.sort_values()
-        l = len(ct)
         l0 = max(l, 10)
         gen_col = generate_colormap(l0)[:l]
         color_dic = {ct[i]: gen_col[i] for i in range(len(ct))}
 
-    long_pairs = adata.uns['geneInter'][adata.uns['geneInter'].annotation == \
-                    'Secreted Signaling'].index.intersection(adata.uns['selected_spots'].index)
-    short_pairs = adata.uns['geneInter'][adata.uns['geneInter'].annotation != \
-                        'Secreted Signaling'].index.intersection(adata.uns['selected_spots'].index)
+    lr = lr_index(adata)
+    long_pairs = lr.pairs[lr.secreted].intersection(_local_pairs(adata))
+    short_pairs = lr.pairs[~lr.secreted].intersection(_local_pairs(adata))
     ls=[]
 
-    for by_range,pairs,w in zip(['long', 'short'],
-                    [long_pairs, short_pairs],
-                 [adata.obsp['weight'], adata.obsp['nearest_neighbors']]):
-        sparse_ct_sum = [[[(csc_matrix(w).multiply(ligand_ct(adata, p)[n1].values).T.multiply(receptor_ct(adata, p)[n2].values)).sum() \
-           for n1 in ct] for n2 in ct] for p in pairs]
-        sparse_ct_sum = np.array(sparse_ct_sum).sum(0)
+    # [source, target, pair] cell type communication of all pairs, in the order of ct
+    pos = adata.obsm['celltypes'].columns.get_indexer(ct)
+    for by_range,pairs in zip(['long', 'short'], [long_pairs, short_pairs]):
+        tensor = celltype_interactions(adata, pairs)[pos][:, pos]
+        sparse_ct_sum = tensor.sum(2).T
 
         Links = pd.DataFrame({'source':np.tile(ct, l),
                     'target':np.repeat(ct, l),
@@ -319,10 +311,9 @@ def plt_util(title):
     plt.colorbar()
 
 
-def plot_selected_pair(sample, pair, spots, selected_ind, figsize, cmap, cmap_l, cmap_r, **kwargs):
-    i = pd.Series(selected_ind == pair).idxmax()
-    L = sample.uns['ligand'].loc[pair].dropna().values
-    R = sample.uns['receptor'].loc[pair].dropna().values
+def plot_selected_pair(sample, pair, results, figsize, cmap, cmap_l, cmap_r, **kwargs):
+    lr = lr_index(sample)
+    L, R = lr.pair_genes(pair, 'ligand'), lr.pair_genes(pair, 'receptor')
     l1, l2 = len(L), len(R)
     
     if isinstance(sample.obsm['spatial'], pd.DataFrame):
@@ -332,9 +323,9 @@ def plot_selected_pair(sample, pair, spots, selected_ind, figsize, cmap, cmap_l,
     
     plt.figure(figsize=figsize)
     plt.subplot(1, 5, 1)
-    plt.scatter(spatial_loc[:,0], spatial_loc[:,1], c=spots.loc[pair], cmap=cmap,
+    plt.scatter(spatial_loc[:,0], spatial_loc[:,1], c=1 - results.p(pair), cmap=cmap,
                 vmax=1, **kwargs)
-    plt_util('Moran: ' + str(sample.uns['local_stat']['n_spots'].loc[pair]) + ' spots')
+    plt_util('Moran: ' + str(results.n_spots(pair)) + ' spots')
     
     for l in range(l1):
         plt.subplot(1, 5, 2 + l)
@@ -348,7 +339,7 @@ def plot_selected_pair(sample, pair, spots, selected_ind, figsize, cmap, cmap_l,
         plt_util('Receptor: ' + R[l])
 
 def plot_pairs(sample, pairs_to_plot, pdf=None, figsize=(35, 5),
-               cmap='Greens', cmap_l='coolwarm', cmap_r='coolwarm', **kwargs):
+               cmap='Greens', cmap_l='coolwarm', cmap_r='coolwarm', results=None, **kwargs):
     """
     plot selected spots as well as LR expression.
     :param sample: AnnData object.
@@ -359,18 +350,16 @@ def plot_pairs(sample, pairs_to_plot, pdf=None, figsize=(35, 5),
     :param cmap: cmap for selected local spots.
     :param cmap_l: cmap for selected ligand. If None, no subplot for ligand expression.
     :param cmap_r: cmap for selected receptor. If None, no subplot for receptor expression
+    :param results: LocalResults to read the local p-values from, e.g. LocalResults(read_spatialdm_store(path)). \
+    Default to LocalResults(sample)
     :return: subplots of spatial scatter plots, 1 for local Moran p-values, others for the original expression values
     """
-    if sample.uns['local_stat']['local_method'] == 'z-score':
-        selected_ind = sample.uns['local_z_p'].index
-        spots = 1 - sample.uns['local_z_p']
-    if sample.uns['local_stat']['local_method'] == 'permutation':
-        selected_ind = sample.uns['local_perm_p'].index
-        spots = 1 - sample.uns['local_perm_p']
+    if results is None:
+        results = LocalResults(sample)
     if pdf != None:
         with PdfPages(pdf + '.pdf') as pdf:
             for pair in pairs_to_plot:
-                plot_selected_pair(sample, pair, spots, selected_ind, figsize, cmap=cmap,
+                plot_selected_pair(sample, pair, results, figsize, cmap=cmap,
                                    cmap_l=cmap_l, cmap_r=cmap_r, **kwargs)
                 pdf.savefig()
                 plt.show()
@@ -378,7 +367,7 @@ def plot_pairs(sample, pairs_to_plot, pdf=None, figsize=(35, 5),
 
     else:
         for pair in pairs_to_plot:
-            plot_selected_pair(sample, pair, spots, selected_ind, figsize, cmap=cmap,
+            plot_selected_pair(sample, pair, results, figsize, cmap=cmap,
                                cmap_l=cmap_l, cmap_r=cmap_r, **kwargs)
             plt.show()
             plt.close()
@@ -0,0 +1,241 @@
+"""
+Chunked HDF5 store for SpatialDM results
+"""
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from .lr_db import LRIndex
+
+# (n_spots, n_pairs) arrays in adata.uns['local_stat'], chunked by pair column
+_LOCAL_SPOT_PAIR = ['local_I', 'local_I_R']
+# (n_pairs, n_spots) arrays in adata.uns / adata.uns['local_stat'], chunked by pair row
+_LOCAL_PAIR_SPOT = ['local_z', 'local_z_p', 'local_perm_p', 'local_perm_n', 'local_fdr']
+_TABLES = ['geneInter', 'ligand', 'receptor', 'global_res']
+
+
+def _strings(x):
+    return np.asarray(x).astype(str).astype(object)
+
+
+def _write_table(group, name, df):
+    """Write a DataFrame column by column with its own dtype; missing strings are masked, not 'NA'."""
+    g = group.create_group(name)
+    g.attrs['columns'] = np.array(df.columns, dtype=object).astype(str).tolist()
+    g.create_dataset('_index', data=_strings(df.index), dtype=h5py.string_dtype())
+    for i, col in enumerate(df.columns):
+        x = df[col]
+        key = 'col%d' % i
+        if isinstance(x.dtype, pd.CategoricalDtype):
+            d = g.create_dataset(key, data=x.cat.codes.values)
+            d.attrs['categories'] = np.asarray(x.cat.categories, dtype=object).astype(str).tolist()
+        elif x.dtype.kind in 'biuf':
+            g.create_dataset(key, data=x.values)
+        else:
+            na = x.isna().values
+            d = g.create_dataset(key, data=np.where(na, '', x.astype(str).values).astype(object),
+                                 dtype=h5py.string_dtype())
+            d.attrs['na'] = na
+            d.attrs['bool'] = (~na).any() and all(isinstance(v, (bool, np.bool_)) for v in x[~na])
+
+
+def _read_table(g):
+    cols = {}
+    for i, col in enumerate(g.attrs['columns']):
+        d = g['col%d' % i]
+        if 'categories' in d.attrs:
+            x = pd.Categorical.from_codes(d[()], categories=list(d.attrs['categories']))
+        elif h5py.check_string_dtype(d.dtype) is not None:
+            x = pd.Series(d.asstr()[()], dtype=object)
+            if d.attrs['bool']:
+                x = x.map({'True': True, 'False': False})
+            x[d.attrs['na']] = np.nan
+            x = x.values
+        else:
+            x = d[()]
+        cols[col] = x
+    return pd.DataFrame(cols, index=pd.Index(g['_index'].asstr()[()]), columns=list(g.attrs['columns']))
+
+
+def _write_stat(group, name, stat, opts):
+    """Write a dict of arrays (e.g. global_stat['perm']) as datasets chunked by pair, scalars as attributes."""
+    g = group.create_group(name)
+    for key, x in stat.items():
+        x = np.asarray(x)
+        if x.ndim == 0:
+            g.attrs[key] = x
+        elif x.size == 0:
+            g.create_dataset(key, data=x)
+        else:
+            g.create_dataset(key, data=x, chunks=(min(x.shape[0], 4096),) + x.shape[1:] if x.ndim == 1
+                             else (1,) + x.shape[1:], **opts)
+
+
+def write_spatialdm_store(adata, filename, compression='gzip', compression_opts=4):
+    """
+    Write SpatialDM results (not the expression data) to a chunked, compressed HDF5 store.
+    Tables keep their dtypes (no 'NA' strings), and the pairs x spots arrays are chunked by pair,
+    so that read_spatialdm_store can pull a single pair without reading the rest.
+    The statistics behind the p-values are written too: global_stat (z: st, z, z_p; perm: n_greater,
+    perm_mean, perm_std, n_perm) and the local exceedance counts local_perm_n, so permutation
+    p-values can be recomputed and the results re-thresholded from the store alone.
+    adata is not modified.
+    :param adata: AnnData object after spatialdm_global / spatialdm_local / sig_spots
+    :param filename: path of the HDF5 file to write (overwritten)
+    :param compression: h5py compression filter, default to 'gzip'. None for no compression.
+    :param compression_opts: compression level
+    """
+    opts = dict(compression=compression, compression_opts=compression_opts if compression == 'gzip' else None)
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('spots', data=_strings(adata.obs_names), dtype=h5py.string_dtype())
+        for key in ['mean', 'num_pairs', 'single_cell']:
+            if key in adata.uns:
+                f.attrs[key] = adata.uns[key]
+        tables = f.create_group('tables')
+        for key in _TABLES:
+            if key in adata.uns and isinstance(adata.uns[key], pd.DataFrame):
+                _write_table(tables, key, adata.uns[key])
+        if 'lr_index' in adata.uns:
+            g = f.create_group('lr_index')
+            for key, x in adata.uns['lr_index'].items():
+                x = np.asarray(x)
+                g.create_dataset(key, data=_strings(x) if x.dtype.kind in 'OUS' else x,
+                                 dtype=h5py.string_dtype() if x.dtype.kind in 'OUS' else None)
+        if 'global_stat' in adata.uns:
+            g = f.create_group('global_stat')
+            for key, stat in adata.uns['global_stat'].items():
+                if isinstance(stat, dict):
+                    _write_stat(g, key, stat, opts)
+                else:
+                    # e.g. the method of sig_pairs
+                    g.attrs[key] = stat
+
+        if 'local_stat' not in adata.uns:
+            return
+        local_stat = adata.uns['local_stat']
+        local = f.create_group('local')
+        N = adata.shape[0]
+        for key in _LOCAL_SPOT_PAIR:
+            if key in local_stat:
+                x = local_stat[key]
+                local.create_dataset(key, data=x, chunks=(N, 1) if x.shape[1] else None, **opts)
+        for key in _LOCAL_PAIR_SPOT:
+            x = local_stat[key] if key in local_stat else adata.uns.get(key)
+            if x is None:
+                continue
+            if isinstance(x, pd.DataFrame):
+                if 'pairs' not in local.attrs:
+                    local.attrs['pairs'] = np.asarray(x.index, dtype=object).astype(str).tolist()
+                x = x.values
+            local.create_dataset(key, data=x, chunks=(1, N) if x.shape[0] else None, **opts)
+        for key in ['n_spots']:
+            if key in local_stat:
+                local.create_dataset(key, data=np.asarray(local_stat[key]))
+        for key in ['local_method', 'n_perm']:
+            if key in local_stat:
+                local.attrs[key] = local_stat[key]
+        if 'pairs' in local_stat:
+            local.attrs['pairs'] = np.asarray(local_stat['pairs'], dtype=object).astype(str).tolist()
+
+        if 'selected_spots' in adata.uns:
+            sel = adata.uns['selected_spots']
+            sel = csr_matrix(sel.values if isinstance(sel, pd.DataFrame) else sel, dtype=bool)
+            g = local.create_group('selected_spots')
+            g.attrs['shape'] = sel.shape
+            g.create_dataset('indptr', data=sel.indptr)
+            g.create_dataset('indices', data=sel.indices, **opts)
+
+
+class SpatialDMStore:
+    """
+    Lazily opened SpatialDM results written by write_spatialdm_store.
+    Tables are read on first access, pairs x spots arrays are returned as h5py datasets
+    and only the requested pairs are read from them.
+    """
+
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        self._tables = {}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def attrs(self):
+        return dict(self.file.attrs)
+
+    @property
+    def spots(self):
+        return pd.Index(self.file['spots'].asstr()[()])
+
+    @property
+    def pairs(self):
+        """Pairs of the local results"""
+        return pd.Index(self.file['local'].attrs['pairs'])
+
+    def table(self, name):
+        """One of 'geneInter', 'ligand', 'receptor', 'global_res' as a DataFrame"""
+        if name not in self._tables:
+            self._tables[name] = _read_table(self.file['tables'][name])
+        return self._tables[name]
+
+    def lr_index(self):
+        """LRIndex of the pairs in the tables"""
+        g = self.file['lr_index']
+        return LRIndex.from_dict({k: g[k].asstr()[()] if h5py.check_string_dtype(g[k].dtype) else g[k][()]
+                                  for k in g})
+
+    def global_stat(self):
+        """adata.uns['global_stat'] as written: {'z': {...}, 'perm': {...}} of arrays and scalars"""
+        out = dict(self.file['global_stat'].attrs)
+        for method, g in self.file['global_stat'].items():
+            out[method] = {k: g[k][()] for k in g}
+            out[method].update(g.attrs)
+        return out
+
+    def __getitem__(self, name):
+        """Lazy h5py dataset of a local array, e.g. store['local_z_p'][i]"""
+        return self.file['local'][name]
+
+    def __contains__(self, name):
+        return 'local' in self.file and name in self.file['local']
+
+    @property
+    def n_spots(self):
+        return pd.Series(self.file['local']['n_spots'][()], index=self.pairs)
+
+    def selected_spots(self, pairs=None):
+        """Boolean CSR matrix of selected spots, for all pairs or the given (positions of) pairs"""
+        g = self.file['local']['selected_spots']
+        indptr = g['indptr'][()]
+        if pairs is None:
+            return csr_matrix((np.ones(indptr[-1], dtype=bool), g['indices'][()], indptr),
+                              shape=tuple(g.attrs['shape']))
+        rows = np.atleast_1d(pairs)
+        indices = [g['indices'][indptr[i]:indptr[i + 1]] for i in rows]
+        new_indptr = np.concatenate(([0], np.cumsum([len(x) for x in indices])))
+        return csr_matrix((np.ones(new_indptr[-1], dtype=bool), np.concatenate(indices + [np.array([], int)]),
+                           new_indptr), shape=(len(rows), g.attrs['shape'][1]))
+
+    def pair(self, pair, name='local_z_p'):
+        """Spot map (n_spots,) of one pair for a local array, reading only that pair's chunk"""
+        i = self.pairs.get_loc(pair)
+        if name in _LOCAL_SPOT_PAIR:
+            return self[name][:, i]
+        return self[name][i]
+
+
+def read_spatialdm_store(filename):
+    """
+    Open a store written by write_spatialdm_store. Nothing but the file header is read until accessed.
+    :param filename: path of the HDF5 store
+    :return: SpatialDMStore (close it, or use it as a context manager, when done)
+    """
+    return SpatialDMStore(filename)
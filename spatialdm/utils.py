@@ -1,16 +1,195 @@
 """
 Utils of permutation calculation
 """
+import os
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import random
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
 from scipy import stats
+from scipy.special import ndtr
 import time
 from tqdm import tqdm
-from scipy.sparse import csc_matrix, csr_matrix, issparse, hstack
+from scipy.sparse import csc_matrix, csr_matrix, issparse, hstack, vstack
+from .store import SpatialDMStore
+from .lr_db import lr_index
 
 
 # pure statistics for bivariate Moran's R
+class SpatialWeights:
+    """Spatial weight matrix with lazily computed, cached moments for the analytical null.
+
+    Each moment is computed on first access and stored in self.moments, which can be a dict kept
+    elsewhere (e.g. adata.uns['weight_moments'][key], see spatial_weights) to reuse it across runs.
+
+    :param W: spatial weight matrix, sparse or dense, (n_sample, n_sample)
+    :param moments: dict holding the cached moments, default to a new one
+    """
+
+    def __init__(self, W, moments=None):
+        self.W = W
+        self.moments = {} if moments is None else moments
+
+    def _cached(self, name, compute):
+        if name not in self.moments:
+            self.moments[name] = compute()
+        return self.moments[name]
+
+    @property
+    def S0(self):
+        """Sum of all weights"""
+        return self._cached('S0', lambda: self.W.sum())
+
+    @property
+    def cross_sum(self):
+        """Sum of W * W.T"""
+        if issparse(self.W):
+            return self._cached('cross_sum', lambda: self.W.multiply(self.W.T).sum())
+        return self._cached('cross_sum', lambda: (self.W * self.W.T).sum())
+
+    @property
+    def row_sums(self):
+        return self._cached('row_sums', lambda: np.asarray(self.W.sum(1)).reshape(-1))
+
+    @property
+    def col_sums(self):
+        return self._cached('col_sums', lambda: np.asarray(self.W.sum(0)).reshape(-1))
+
+    @property
+    def row_col_sum(self):
+        """Sum over spots of row sum * column sum"""
+        if issparse(self.W):
+            return self._cached('row_col_sum', lambda: (self.W.sum(0) @ self.W.sum(1)).sum())
+        return self._cached('row_col_sum', lambda: (self.W.sum(1) * self.W.sum(0)).sum())
+
+    @property
+    def sq_row_sums(self):
+        """Sum of squared weights per row"""
+        if issparse(self.W):
+            return self._cached('sq_row_sums', lambda: np.asarray(self.W.power(2).sum(1)).reshape(-1))
+        return self._cached('sq_row_sums', lambda: (self.W ** 2).sum(1))
+
+    @property
+    def S1(self):
+        """1/2 * sum of (w_ij + w_ji) ** 2"""
+        return self.sq_row_sums.sum() + self.cross_sum
+
+    @property
+    def S2(self):
+        """Sum over spots of (row sum + column sum) ** 2"""
+        return ((self.row_sums + self.col_sums) ** 2).sum()
+
+    def operand(self, kernel='sparse', dtype=None):
+        """W in the layout used by a matmul kernel: CSR for 'sparse' / 'blocked', ndarray for 'dense'.
+        Conversions are kept on the object (not in self.moments) for the following products.
+        """
+        dtype = self.W.dtype if dtype is None else np.dtype(dtype)
+        layout = 'dense' if kernel == 'dense' or not issparse(self.W) else 'csr'
+        cache = self.__dict__.setdefault('_operands', {})
+        if (layout, dtype) not in cache:
+            if layout == 'dense':
+                cache[layout, dtype] = self.W.toarray().astype(dtype, copy=False) if issparse(self.W) \
+                    else np.asarray(self.W, dtype=dtype)
+            else:
+                cache[layout, dtype] = csr_matrix(self.W, dtype=dtype)
+        return cache[layout, dtype]
+
+    def moran_std(self):
+        """Standard deviation of Moran's R under the null distribution."""
+        N = self.W.shape[0]
+        nm = N ** 2 * self.cross_sum - 2 * N * self.row_col_sum + self.S0 ** 2
+        dm = N ** 2 * (N - 1) ** 2
+        return np.sqrt(nm / dm)
+
+
+def _blocked_matmul(W, X, nproc):
+    """W @ X for CSR W with row blocks on nproc threads (scipy releases the GIL in the kernel)."""
+    out = np.empty((W.shape[0], X.shape[1]), dtype=np.result_type(W.dtype, X.dtype))
+    bounds = np.linspace(0, W.shape[0], nproc + 1).astype(int)
+
+    def _rows(i):
+        out[bounds[i]:bounds[i + 1]] = W[bounds[i]:bounds[i + 1]] @ X
+
+    with ThreadPoolExecutor(nproc) as ex:
+        list(ex.map(_rows, range(nproc)))
+    return out
+
+
+# widest probe of matmul_kernel; beyond it the relative speed of the kernels hardly changes
+_PROBE_COLS = 4096
+
+
+def matmul_kernel(weights, n_cols, nproc=1, max_memory=1024, dtype=None):
+    """Fastest way to compute W @ X for a SpatialWeights: 'sparse' (CSR x dense), 'dense' (BLAS on a
+    dense copy of W) or 'blocked' (row blocks of CSR x dense on nproc threads).
+
+    Dense is only considered when the copy fits in max_memory (MB) and W has at least 2% non-zeros,
+    blocked only for nproc > 1. The remaining candidates are timed once on a random (n_spots, n_cols)
+    probe, at most _PROBE_COLS wide. The fastest kernel depends on the width of X, so the choice is
+    cached in weights.moments per nproc, dtype and power-of-two class of n_cols.
+    """
+    W = weights.W
+    if not issparse(W):
+        return 'dense'
+    dtype = W.dtype if dtype is None else np.dtype(dtype)
+    n_cols = max(1, int(n_cols))
+    key = 'kernel_%d_%s_%d' % (nproc, dtype.str, n_cols.bit_length())
+    if key in weights.moments:
+        return weights.moments[key]
+    N = W.shape[0]
+    candidates = ['sparse']
+    if nproc > 1:
+        candidates.append('blocked')
+    if N * N * dtype.itemsize <= max_memory * 1024 ** 2 and W.nnz >= 0.02 * N * N:
+        candidates.append('dense')
+    if len(candidates) > 1:
+        X = np.random.default_rng(0).random((N, min(n_cols, _PROBE_COLS)), dtype=np.float32).astype(dtype, copy=False)
+        timing = {}
+        for kernel in candidates:
+            weights.operand(kernel, dtype)
+            t0 = time.perf_counter()
+            spatial_matmul(weights, X, kernel, nproc)
+            timing[kernel] = time.perf_counter() - t0
+        candidates = [min(timing, key=timing.get)]
+    weights.moments[key] = candidates[0]
+    return candidates[0]
+
+
+def spatial_matmul(weights, X, kernel=None, nproc=1, max_memory=1024):
+    """W @ X with the kernel chosen by matmul_kernel (or the one given).
+
+    :param weights: SpatialWeights
+    :param X: dense (n_spots, k) array
+    :return: dense (n_spots, k) array
+    """
+    if kernel is None:
+        kernel = matmul_kernel(weights, X.shape[1], nproc, max_memory, X.dtype)
+    W = weights.operand(kernel, X.dtype)
+    if kernel == 'blocked' and nproc > 1:
+        return _blocked_matmul(W, X, nproc)
+    return np.asarray(W @ X)
+
+
+def spatial_weights(adata, key='weight'):
+    """SpatialWeights of adata.obsp[key], with the moments cached in adata.uns['weight_moments'][key].
+    weight_matrix drops the cache whenever it writes the graphs; a matrix replaced by other means is
+    caught by its shape, dtype, number of non-zeros and the sum and sum of squares of its values
+    (one O(nnz) pass, cheaper than any product with W).
+    """
+    W = adata.obsp[key]
+    values = W.data if issparse(W) else np.asarray(W)
+    fingerprint = _fingerprint(W.shape, W.dtype, W.nnz if issparse(W) else None,
+                               values.sum(dtype=np.float64), np.square(values, dtype=np.float64).sum())
+    cache = adata.uns.setdefault('weight_moments', {})
+    if key not in cache or cache[key].get('key') != fingerprint:
+        cache[key] = {'key': fingerprint}
+    return SpatialWeights(W, cache[key])
+
+
 def Moran_R_std(spatial_W, by_trace=False):
     """Calculate standard deviation of Moran's R under the null distribution.
     """
@@ -21,19 +200,8 @@ def Moran_R_std(spatial_W, by_trace=False):
         H = np.identity(N) - np.ones((N, N)) / N
         HWH = H.dot(W.dot(H))
         var = np.trace(HWH.dot(HWH)) * N**2 / (np.sum(W) * (N-1))**2
-    else:
-        if issparse(spatial_W):
-            nm = N ** 2 * spatial_W.multiply(spatial_W.T).sum() \
-                - 2 * N * (spatial_W.sum(0) @ spatial_W.sum(1)).sum() \
-                + spatial_W.sum() ** 2
-        else:
-            nm = N ** 2 * (spatial_W * spatial_W.T).sum() \
-                - 2 * N * (spatial_W.sum(1) * spatial_W.sum(0)).sum() \
-                + spatial_W.sum() ** 2
-        dm = N ** 2 * (N - 1) ** 2
-        var = nm / dm
-    
-    return np.sqrt(var)
+        return np.sqrt(var)
+    return SpatialWeights(spatial_W).moran_std()
 
 
 def Moran_R(X, Y, spatial_W, standardise=True, nproc=1):
@@ -55,19 +223,12 @@ def Moran_R(X, Y, spatial_W, standardise=True, nproc=1):
         X = (X - np.mean(X, axis=0, keepdims=True)) / np.std(X, axis=0, keepdims=True)
         Y = (Y - np.mean(Y, axis=0, keepdims=True)) / np.std(Y, axis=0, keepdims=True)
         
-    # Consider to dense array for speedup (numpy's codes is optimised)
-    if X.shape[0] <= 5000 and issparse(spatial_W):
-        # Note, numpy may use unnessary too many threads
-        # You may use threadpool.threadpool_limits() outside
-        from threadpoolctl import threadpool_limits
-        
-        with threadpool_limits(limits=nproc, user_api='blas'):
-            R_val = (spatial_W.A @ X * Y).sum(axis=0) / np.sum(spatial_W)
-    else:
-        # we assume it's sparse spatial_W when sample size > 5000
-        R_val = (spatial_W @ X * Y).sum(axis=0) / np.sum(spatial_W)
-        
-    _R_std = Moran_R_std(spatial_W)
+    # one product in the layout spatial_W comes in; a one-off call is cheaper than timing the kernels
+    weights = SpatialWeights(spatial_W)
+    with threadpool_limits(limits=nproc, user_api='blas'):
+        R_val = (np.asarray(spatial_W @ X) * Y).sum(axis=0) / weights.S0
+
+    _R_std = weights.moran_std()
     R_z_score = R_val / _R_std
     R_p_val = stats.norm.sf(R_z_score)
     
@@ -76,57 +237,221 @@ def Moran_R(X, Y, spatial_W, standardise=True, nproc=1):
 
 # global variance
 def globle_st_compute(adata):
-    N = adata.shape[0]
+    st = spatial_weights(adata, 'weight').moran_std()
+    st0 = spatial_weights(adata, 'nearest_neighbors').moran_std()
+    return np.where(lr_index(adata).secreted, st, st0)
 
-    if issparse(adata.obsp['weight']):
-        nm = N ** 2 * adata.obsp['weight'].multiply(adata.obsp['weight'].T).sum() \
-            - 2 * N * (adata.obsp['weight'].sum(0) @ adata.obsp['weight'].sum(1)).sum() \
-            + adata.obsp['weight'].sum() ** 2
-        nm0 = N ** 2 * adata.obsp['nearest_neighbors'].multiply(adata.obsp['nearest_neighbors'].T).sum() \
-            - 2 * N * (adata.obsp['nearest_neighbors'].sum(0) @ adata.obsp['nearest_neighbors'].sum(1)).sum() \
-            + adata.obsp['nearest_neighbors'].sum() ** 2
-    else:
-        nm = N ** 2 * (adata.obsp['weight'] * adata.obsp['weight'].T).sum() \
-            - 2 * N * (adata.obsp['weight'].sum(1) * adata.obsp['weight'].sum(0)).sum() \
-            + adata.obsp['weight'].sum() ** 2
-        nm0 = N ** 2 * (adata.obsp['nearest_neighbors'] * adata.obsp['nearest_neighbors'].T).sum() \
-            - 2 * N * (adata.obsp['nearest_neighbors'].sum(1) * adata.obsp['nearest_neighbors'].sum(0)).sum() \
-            + adata.obsp['nearest_neighbors'].sum() ** 2
-        
-    dm = N ** 2 * (N - 1) ** 2
-    var = np.hstack(
-        (np.repeat(nm0, adata.uns['geneInter'].annotation.isin(['ECM-Receptor', 'Cell-Cell Contact']).sum()),
-         np.repeat(nm, adata.uns['geneInter'].annotation.isin(['Secreted Signaling']).sum()))) / dm
-    st = var ** (1 / 2)
-    return st
-
-def global_I_compute(adata, L_mat, R_mat, n_short_lri, permute=False):
+def global_I_compute(adata, L_mat, R_mat, n_short_lri, permute=False, nproc=1):
     """Calculate global I (i.e., R) values
     Make sure L_mat and R_mat are numpy.array not matrix
     """
     if permute:
         _idx = np.random.permutation(L_mat.shape[0])
-        L_mat0, R_mat0 = L_mat[_idx, :n_short_lri], R_mat[_idx, :n_short_lri]
-        L_mat1, R_mat1 = L_mat[_idx, n_short_lri:], R_mat[_idx, n_short_lri:]
-    else:
-        L_mat0, R_mat0 = L_mat[:, :n_short_lri], R_mat[:, :n_short_lri]
-        L_mat1, R_mat1 = L_mat[:, n_short_lri:], R_mat[:, n_short_lri:]
-
-    # Consider to dense array for speedup (numpy's codes is optimised)
-    if adata.shape[0] >= 5000 or ~issparse(adata.obsp['weight']):
-        RV = np.hstack((
-            (adata.obsp['nearest_neighbors'] @ L_mat0 * R_mat0).sum(axis=0),
-            (adata.obsp['weight'] @ L_mat1 * R_mat1).sum(axis=0)
-        ))
-    else:
-        # Note, numpy may use unnessary too many threads
-        # You may use threadpool.threadpool_limits() outside
-        RV = np.hstack((
-            (adata.obsp['nearest_neighbors'].A @ L_mat0 * R_mat0).sum(axis=0),
-            (adata.obsp['weight'].A @ L_mat1 * R_mat1).sum(axis=0)
-        ))
+        L_mat, R_mat = L_mat[_idx], R_mat[_idx]
+    RV = []
+    for key, cols in [('nearest_neighbors', slice(None, n_short_lri)), ('weight', slice(n_short_lri, None))]:
+        RV.append((spatial_matmul(spatial_weights(adata, key), L_mat[:, cols], nproc=nproc) *
+                   R_mat[:, cols]).sum(axis=0))
+    return np.hstack(RV)
+
+
+def _perm_block(W, L_mat, R_mat, perms):
+    """Moran's R of L_mat/R_mat for a block of spot permutations in one sparse-dense product.
+    L_mat[perm] for all perms are stacked side by side, so W is scanned once per block.
 
-    return RV
+    :return: (n_pairs, len(perms)) array
+    """
+    n_pairs = L_mat.shape[1]
+    L_perm = np.concatenate([L_mat[_idx] for _idx in perms], axis=1)
+    R_perm = np.concatenate([R_mat[_idx] for _idx in perms], axis=1)
+    RV = (W @ L_perm * R_perm).sum(axis=0)
+    return RV.reshape(len(perms), n_pairs).T
+
+
+def _local_perm_block(W, L_mat, R_mat, perms):
+    """Local I and local I_R for a block of permutations of the partner (neighbor) spots.
+
+    :return: two (n_pairs, len(perms), n_spots) arrays
+    """
+    N, n_pairs = L_mat.shape
+    WR = W @ np.concatenate([R_mat[_idx] for _idx in perms], axis=1)
+    WL = W @ np.concatenate([L_mat[_idx] for _idx in perms], axis=1)
+    permI = WR.reshape(N, len(perms), n_pairs) * L_mat[:, None, :]
+    permI_R = WL.reshape(N, len(perms), n_pairs) * R_mat[:, None, :]
+    return permI.transpose(2, 1, 0), permI_R.transpose(2, 1, 0)
+
+
+def _perm_seeds(seed, n_perm):
+    """One independent random stream per permutation, so results do not depend on how \
+    permutations are split into blocks or processes.
+    Without a seed, the entropy is drawn from np.random, so np.random.seed() still applies.
+    """
+    if seed is None:
+        seed = np.random.randint(2 ** 32, dtype=np.uint64)
+    return np.random.SeedSequence(seed).spawn(n_perm)
+
+
+def _block_size(n_perm, n_spots, n_pairs, itemsize, n_buffers, max_memory, nproc):
+    """Number of permutations per block so that all workers together stay within max_memory (MB),
+    and every one of the nproc workers gets a block."""
+    per_perm = n_buffers * n_spots * max(n_pairs, 1) * itemsize
+    return int(max(1, min(-(-n_perm // nproc), max_memory * 1024 ** 2 // (per_perm * nproc))))
+
+
+# arrays shared with pool workers through memory-mapped files
+_SHARED = {}
+
+
+def _share(x, tmpdir, name):
+    """Dump an array (dense or sparse) to tmpdir and return a descriptor to memory-map it"""
+    if issparse(x):
+        x = csr_matrix(x)
+        parts = {}
+        for attr in ['data', 'indices', 'indptr']:
+            parts[attr] = os.path.join(tmpdir, '%s_%s.npy' % (name, attr))
+            np.save(parts[attr], getattr(x, attr))
+        return ('sparse', parts, x.shape)
+    path = os.path.join(tmpdir, name + '.npy')
+    np.save(path, np.ascontiguousarray(x))
+    return ('dense', path, None)
+
+
+def _load_shared(desc):
+    kind, path, shape = desc
+    if kind == 'sparse':
+        parts = {k: np.load(v, mmap_mode='r') for k, v in path.items()}
+        return csr_matrix((parts['data'], parts['indices'], parts['indptr']), shape=shape, copy=False)
+    return np.load(path, mmap_mode='r')
+
+
+def _init_perm_worker(descs):
+    # one BLAS thread per process, parallelism comes from the pool
+    _SHARED['_limits'] = threadpool_limits(limits=1, user_api='blas')
+    for k, desc in descs.items():
+        _SHARED[k] = _load_shared(desc)
+
+
+def _run_shared_task(task, descs, args):
+    arrays = dict(_SHARED)
+    arrays.update({k: _load_shared(desc) for k, desc in descs.items()})
+    return task(arrays, *args)
+
+
+class _PermPool:
+    """Process pool for blocks of permutations, whose workers memory-map the shared arrays (e.g. W) once.
+
+    Arrays that change between calls of run (e.g. L / R of a block of pairs) are dumped for that call
+    only and memory-mapped by its tasks. With nproc <= 1 the tasks run in this process.
+
+    :param nproc: number of worker processes
+    :param arrays: dict of arrays (dense or sparse) shared by all calls of run
+    """
+
+    def __init__(self, nproc, arrays):
+        self.arrays = arrays
+        self.pool = self.tmpdir = None
+        if nproc > 1:
+            self.tmpdir = tempfile.TemporaryDirectory()
+            descs = {k: _share(v, self.tmpdir.name, k) for k, v in arrays.items()}
+            self.pool = ProcessPoolExecutor(max_workers=nproc, initializer=_init_perm_worker, initargs=(descs,))
+
+    def run(self, task, tasks, arrays=None):
+        """task(arrays, *args) for every args in tasks, arrays being the shared ones updated with arrays"""
+        arrays = {} if arrays is None else arrays
+        if self.pool is None:
+            return [task({**self.arrays, **arrays}, *args) for args in tqdm(tasks)]
+        with tempfile.TemporaryDirectory(dir=self.tmpdir.name) as tmpdir:
+            descs = {k: _share(v, tmpdir, k) for k, v in arrays.items()}
+            return list(tqdm(self.pool.map(_run_shared_task, [task] * len(tasks), [descs] * len(tasks), tasks),
+                             total=len(tasks)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.tmpdir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _run_perm_tasks(task, arrays, tasks, nproc=1):
+    """Run task(arrays, *args) for every args in tasks, in a process pool if nproc > 1.
+    arrays are memory-mapped by the workers rather than pickled per task.
+    """
+    with _PermPool(nproc if len(tasks) > 1 else 1, arrays) as pool:
+        return pool.run(task, tasks)
+
+
+def _global_perm_task(arrays, n_short_lri, seeds, keep_perm=False):
+    """Exceedance counts and running sums of the permuted global I of one block.
+    The block's null values are discarded unless keep_perm.
+    """
+    L_mat, R_mat = arrays['L'], arrays['R']
+    perms = [np.random.default_rng(s).permutation(L_mat.shape[0]) for s in seeds]
+    RV = np.zeros((L_mat.shape[1], len(perms)), dtype=L_mat.dtype)
+    for W, cols in [(arrays['nearest_neighbors'], slice(None, n_short_lri)),
+                    (arrays['weight'], slice(n_short_lri, None))]:
+        if L_mat[:, cols].shape[1] > 0:
+            RV[cols] = _perm_block(W, L_mat[:, cols], R_mat[:, cols], perms)
+    n_greater = (arrays['obs'][:, None] > RV).sum(1)
+    RV64 = RV.astype(np.float64)
+    return n_greater, RV64.sum(1), (RV64 ** 2).sum(1), (RV if keep_perm else None)
+
+
+def _local_perm_task(arrays, seeds, keep_perm=False):
+    """Per pair x spot counts of permuted local I (+ I_R) reaching the observed value.
+    The block's null values are discarded unless keep_perm.
+    """
+    L_mat = arrays['L']
+    perms = [np.random.default_rng(s).permutation(L_mat.shape[0]) for s in seeds]
+    permI, permI_R = _local_perm_block(arrays['W'], L_mat, arrays['R'], perms)
+    n_exceed = (arrays['obs'][:, None, :] <= permI + permI_R).sum(1, dtype=np.int32)
+    if keep_perm:
+        return n_exceed, permI, permI_R
+    return n_exceed, None, None
+
+
+def global_perm_compute(adata, L_mat, R_mat, n_short_lri, n_perm, max_memory=1024, nproc=1, seed=None,
+                        keep_perm=False):
+    """Null distribution of global I by permuting spot labels, in blocks of permutations.
+    Each block only updates running counters, so memory does not grow with n_perm.
+
+    :param L_mat: standardised ligand matrix, (n_spots, n_pairs)
+    :param R_mat: standardised receptor matrix, (n_spots, n_pairs)
+    :param n_short_lri: number of leading pairs using adata.obsp['nearest_neighbors']
+    :param n_perm: number of permutations
+    :param max_memory: memory budget (MB) of the stacked (n_spots, block * n_pairs) buffers
+    :param nproc: number of worker processes the blocks are distributed over
+    :param seed: seed of the permutation streams; results are identical for any nproc.
+    :param keep_perm: if True, also return the full (n_pairs, n_perm) null.
+    :return: dict with 'n_greater' (permutations below the observed global I), 'perm_mean', \
+    'perm_std' and optionally 'global_perm'
+    """
+    N, n_pairs = L_mat.shape
+    # three stacked buffers per block: permuted L, permuted R and W @ permuted L
+    block = _block_size(n_perm, N, n_pairs, L_mat.dtype.itemsize, 3, max_memory, nproc)
+    seeds = _perm_seeds(seed, n_perm)
+    tasks = [(n_short_lri, seeds[i:i + block], keep_perm) for i in range(0, n_perm, block)]
+    arrays = {'L': L_mat, 'R': R_mat, 'obs': np.asarray(adata.uns['global_I'])}
+    for key, n_cols in [('nearest_neighbors', n_short_lri), ('weight', n_pairs - n_short_lri)]:
+        # each worker multiplies single-threaded, so the kernel is chosen for one thread
+        weights = spatial_weights(adata, key)
+        arrays[key] = weights.operand(matmul_kernel(weights, block * n_cols, 1, max_memory, L_mat.dtype),
+                                      L_mat.dtype)
+    res = _run_perm_tasks(_global_perm_task, arrays, tasks, nproc)
+
+    perm_sum = np.sum([x[1] for x in res], axis=0)
+    perm_sq = np.sum([x[2] for x in res], axis=0)
+    perm_mean = perm_sum / n_perm
+    out = {'n_greater': np.sum([x[0] for x in res], axis=0),
+           'perm_mean': perm_mean.astype(L_mat.dtype),
+           'perm_std': np.sqrt(np.maximum(perm_sq / n_perm - perm_mean ** 2, 0)).astype(L_mat.dtype)}
+    if keep_perm:
+        out['global_perm'] = np.hstack([x[3] for x in res])
+    return out
 
 
 def generate_perm_tbl(adata, n_perm, num_spots):
@@ -164,70 +489,270 @@ def _standardise(X, Local=False, axis=None):
     return X
 
 
-def pair_selection_matrix(adata, n_perm, sel_ind, method):
-    if adata.uns['mean'] == 'geometric':
-        from scipy.stats.mstats import gmean
+def resolve_subunits(names, comp, var_names):
+    """Subunit genes of ligand / receptor names, restricted to var_names.
+    Complex names are looked up in the CellChatDB complex table, other names are genes themselves.
+
+    :param names: ligand or receptor names from the interaction table
+    :param comp: complex table, one row of subunit columns per complex
+    :param var_names: genes available in the expression matrix
+    :return: pd.Series of gene arrays (in subunit order), indexed by the unique names
+    """
+    uniq = pd.unique(np.asarray(names))
+    is_comp = pd.Index(uniq).isin(comp.index)
+    sub = comp.loc[uniq[is_comp]].stack()
+    long = pd.DataFrame({'name': np.concatenate((sub.index.get_level_values(0), uniq[~is_comp])),
+                         'gene': np.concatenate((sub.values, uniq[~is_comp]))})
+    long = long[long.gene.isin(var_names)]
+    genes = long.groupby('name', sort=False).gene.agg(lambda x: x.values)
+    return genes.reindex(uniq).apply(lambda x: x if isinstance(x, np.ndarray) else np.array([], dtype=object))
+
+
+def _subunit_aggregation(subunits, var_names):
+    """Sparse (genes x complexes) matrix averaging the subunits of each complex.
+
+    :param subunits: pd.Series of gene arrays per complex, as from resolve_subunits
+    :return: (indices of the used genes in var_names, (n_used_genes, n_complexes) csr matrix)
+    :raises KeyError: if a subunit gene is not in var_names (e.g. missing from adata.raw)
+    """
+    n_sub = subunits.apply(len).values
+    genes = np.concatenate([np.asarray(x, dtype=object) for x in subunits.values] + [np.array([], dtype=object)])
+    used, gene_code = np.unique(genes.astype(str), return_inverse=True)
+    col = np.repeat(np.arange(len(subunits)), n_sub)
+    agg = csr_matrix((1 / np.repeat(n_sub, n_sub), (gene_code, col)), shape=(len(used), len(subunits)))
+    gene_idx = pd.Index(var_names).get_indexer(used)
+    if (gene_idx < 0).any():
+        raise KeyError('Subunit genes not found in the expression matrix: {}'.format(list(used[gene_idx < 0])))
+    return gene_idx, agg
+
+
+def _geometric_mean(X, agg):
+    """Geometric mean of the subunits of every complex.
+
+    For sparse X the logs are taken over the stored non-zeros only, and the number of expressed
+    subunits (a product with the binary membership matrix) decides which entries are non-zero:
+    a complex with any unexpressed subunit gets 0, so only fully expressed entries are evaluated.
+    """
+    if not issparse(X):
+        # log(0) = -inf propagates, so a complex with any unexpressed subunit gets 0
+        with np.errstate(divide='ignore'):
+            return np.exp(np.asarray(np.log(np.asarray(X)) @ agg))
+    X = csr_matrix(X, copy=True)
+    X.eliminate_zeros()
+    member, expressed = csc_matrix(agg, copy=True), X.copy()
+    member.data[:], expressed.data[:] = 1, 1
+    n_expressed = (expressed @ member).tocoo()
+    full = n_expressed.data == np.diff(member.indptr)[n_expressed.col]
+    rows, cols = n_expressed.row[full], n_expressed.col[full]
+    X.data = np.log(X.data)
+    mean_log = np.asarray((X @ agg).tocsr()[rows, cols]).ravel()
+    return csr_matrix((np.exp(mean_log), (rows, cols)), shape=n_expressed.shape)
+
+
+def aggregate_subunits(X, agg, mean='algebra'):
+    """Arithmetic ('algebra') or geometric mean of the subunits of every complex at once.
+    Single-gene complexes are taken as they are in both cases.
+
+    :param X: expression of the used genes, (n_spots, n_used_genes), sparse or dense
+    :param agg: (n_used_genes, n_complexes) averaging matrix from _subunit_aggregation
+    :return: (n_spots, n_complexes), sparse if X is sparse
+    """
+    agg = csc_matrix(agg)
+    multi = np.flatnonzero(np.diff(agg.indptr) > 1)
+    if mean != 'geometric' or len(multi) == 0:
+        return X @ agg
+    single = np.flatnonzero(np.diff(agg.indptr) <= 1)
+    res = [X @ agg[:, single], _geometric_mean(X, agg[:, multi])]
+    order = np.argsort(np.concatenate((single, multi)))
+    if issparse(X):
+        return hstack(res, format='csc')[:, order].tocsr()
+    return np.hstack(res)[:, order]
+
+
+def _fingerprint(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(np.ascontiguousarray(part).tobytes() if isinstance(part, np.ndarray) else str(part).encode())
+    return h.hexdigest()
+
+
+def _is_backed(X):
+    """True for on-disk matrices (h5py / zarr arrays, anndata backed sparse datasets)."""
+    return not (isinstance(X, np.ndarray) or issparse(X))
+
+
+def _read_columns(X, idx, max_memory=1024):
+    """Columns idx of an in-memory or backed matrix.
+    Backed matrices are read in row chunks of about max_memory MB, keeping only the selected columns.
+    """
+    if not _is_backed(X):
+        return X[:, idx]
+    chunk = max(1, int(max_memory * 2 ** 20 // (X.shape[1] * np.dtype(X.dtype).itemsize)))
+    blocks = []
+    for start in range(0, X.shape[0], chunk):
+        block = X[start:start + chunk]
+        blocks.append(csr_matrix(block)[:, idx] if issparse(block) else np.asarray(block)[:, idx])
+    if issparse(blocks[0]):
+        return vstack(blocks, format='csr')
+    return np.vstack(blocks)
+
+
+def _matrix_fingerprint(X, var_names, filename=None):
+    """Cheap fingerprint of an expression matrix: shape, non-zeros, genes and per-gene sums.
+    Backed matrices are identified by their file and its modification time instead of being read.
+    """
+    if _is_backed(X):
+        stat = os.stat(filename)
+        return _fingerprint(X.shape, X.dtype, np.asarray(var_names, dtype=str), filename, stat.st_mtime_ns, stat.st_size)
+    return _fingerprint(X.shape, X.dtype, X.nnz if issparse(X) else None,
+                        np.asarray(var_names, dtype=str), np.asarray(X.sum(0), dtype=np.float64).ravel())
+
+
+def _normalise_raw(X, scale_X=True):
+    """Max-normalise each gene of raw counts and optionally scale it to unit variance,
+    as sc.pp.scale(zero_center=False) does (ddof=1, genes without variance left unscaled).
+    Sparse input is processed on the CSC data array, one scaling factor per column.
+
+    :param X: raw counts of the used genes, (n_spots, n_genes)
+    :return: csc matrix for sparse input, ndarray otherwise
+    """
+    dtype = np.result_type(X.dtype, np.float32)
+    N = X.shape[0]
+    if issparse(X):
+        X = csc_matrix(X, dtype=dtype, copy=True)
+        X.sum_duplicates()
+        nnz = np.diff(X.indptr)
+        col = np.repeat(np.arange(X.shape[1]), nnz)
+        col_max = np.zeros(X.shape[1], dtype=dtype)
+        col_max[nnz > 0] = np.maximum.reduceat(X.data, X.indptr[:-1][nnz > 0])
+        col_max[nnz < N] = np.maximum(col_max[nnz < N], 0)
+        X.data *= np.divide(1, col_max, out=np.zeros_like(col_max), where=col_max != 0)[col]
+        col_sum = np.bincount(col, weights=X.data, minlength=X.shape[1])
+        col_sq = np.bincount(col, weights=X.data ** 2, minlength=X.shape[1])
+    else:
+        X = np.array(X, dtype=dtype)
+        col_max = X.max(0)
+        X *= np.divide(1, col_max, out=np.zeros_like(col_max), where=col_max != 0)
+        col_sum, col_sq = X.sum(0, dtype=np.float64), (X.astype(np.float64) ** 2).sum(0)
+    if scale_X:
+        var = np.maximum(col_sq / N - (col_sum / N) ** 2, 0) * N / (N - 1)
+        std = np.sqrt(var)
+        std[std == 0] = 1
+        if issparse(X):
+            X.data /= std.astype(dtype)[col]
+        else:
+            X /= std.astype(dtype)
+    return X
+
+
+def complex_means(adata, subunits, source='X', scale_X=True, max_memory=1024):
+    """Spot x complex matrix of averaged subunit expression, cached in adata.obsm.
+
+    Aggregates are stored in adata.obsm['lr_mean_' + source] with their complex labels and a key
+    in adata.uns['lr_mean'][source]. The key covers the mean type, the input matrix (a fingerprint
+    of its shape, genes and per-gene sums) and, for raw counts, scale_X, so a change in any of them
+    triggers recomputation. Complexes not cached yet are computed and appended.
+
+    adata may be backed (sc.read_h5ad(..., backed='r')): only the subunit gene columns are read,
+    chunk-wise, so the expression matrix never has to fit in memory.
+
+    :param adata: AnnData with adata.uns['mean'] set by extract_lr
+    :param subunits: pd.Series of subunit gene arrays, indexed by complex label (see LRIndex.subunits)
+    :param source: 'X' for adata.X (global selection), 'raw' for max-normalised adata.raw (local selection)
+    :param scale_X: scale the normalised raw counts to unit variance (source='raw' only)
+    :param max_memory: memory budget in MB for one chunk of a backed matrix
+    :return: (n_spots, len(subunits)) matrix, sparse if the input is sparse and mean='algebra'
+    """
+    M, idx = _complex_cache(adata, subunits, source, scale_X, max_memory)
+    return M[:, idx]
+
+
+def _complex_cache(adata, subunits, source='X', scale_X=True, max_memory=1024):
+    """Fill the complex_means cache and return the cached matrix with the columns of subunits."""
+    X, var_names = (adata.X, adata.var_names) if source == 'X' else (adata.raw.X, adata.raw.var_names)
+    mean = adata.uns['mean']
+    key = _fingerprint(mean, source, source == 'raw' and scale_X, _matrix_fingerprint(X, var_names, adata.filename))
+    obsm_key = 'lr_mean_' + source
+    cache = adata.uns.setdefault('lr_mean', {}).get(source)
+    if cache is None or cache['key'] != key or obsm_key not in adata.obsm:
+        cache = {'key': key, 'complexes': np.array([], dtype=object)}
+        adata.obsm[obsm_key] = np.zeros((adata.shape[0], 0), dtype=np.float32)
+
+    missing = subunits[~subunits.index.isin(cache['complexes']) & ~subunits.index.duplicated()]
+    if len(missing) > 0:
+        gene_idx, agg = _subunit_aggregation(missing, var_names)
+        X_use = _read_columns(X, gene_idx, max_memory)
+        if source == 'raw':
+            X_use = _normalise_raw(X_use, scale_X)
+        M = aggregate_subunits(X_use, agg, mean)
+        M = M.astype(np.result_type(M.dtype, np.float32) if M.dtype.kind == 'f' else np.float32, copy=False)
+        old = adata.obsm[obsm_key]
+        if old.shape[1] > 0:
+            M = hstack([old, M], format='csr') if issparse(M) or issparse(old) else np.hstack([old, M])
+        adata.obsm[obsm_key] = M
+        cache = {'key': key, 'complexes': np.append(cache['complexes'], missing.index.values).astype(object)}
+    adata.uns['lr_mean'][source] = cache
+    return adata.obsm[obsm_key], pd.Index(cache['complexes']).get_indexer(subunits.index)
+
+
+def _lr_columns(adata, index, source='X', scale_X=True, max_memory=1024):
+    """Cached spot x complex matrix and the ligand / receptor columns of every pair of an LRIndex."""
+    sub_L, sub_R = index.subunits('ligand'), index.subunits('receptor')
+    M, idx = _complex_cache(adata, pd.concat([sub_L, sub_R]), source, scale_X, max_memory)
+    return M, idx[:len(sub_L)], idx[len(sub_L):]
+
+
+def _dense_columns(M, idx, dtype=np.float32):
+    """Dense (n_spots, len(idx)) columns of the cached aggregate matrix."""
+    M = M[:, idx]
+    return (M.toarray() if issparse(M) else np.asarray(M)).astype(dtype, copy=False)
+
+
+def _lr_means(adata, index, source='X', scale_X=True, dtype=np.float32, max_memory=1024):
+    """Dense (n_pairs, n_spots) averaged ligand and receptor expression of the pairs of an LRIndex."""
+    M, L_idx, R_idx = _lr_columns(adata, index, source, scale_X, max_memory)
+    return [np.ascontiguousarray(_dense_columns(M, idx, dtype).T) for idx in [L_idx, R_idx]]
+
+
+def _empty_store(shape, dtype, store=None, name=None):
+    """Zero-filled array, memory-mapped to store/<name>.npy if a store directory is given."""
+    if store is None:
+        return np.zeros(shape, dtype=dtype)
+    os.makedirs(store, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(store, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def pair_selection_matrix(adata, n_perm, sel_ind, method, dtype=np.float32, max_memory=1024,
+                          nproc=1, seed=None, keep_perm=False):
     # local variables (only live in this function scope)
-    ligand = adata.uns['ligand'].loc[sel_ind]
-    receptor = adata.uns['receptor'].loc[sel_ind]
-    type_interaction = adata.uns['geneInter'].loc[sel_ind, 'annotation']
-    n_short_lri = (type_interaction != 'Secreted Signaling').sum()
-
-    # averaged ligand values
-    L1 = [pd.Series(x[0]).dropna().values for x in ligand.values]
-    L_mat = [adata[:, L1[l]].X.astype(np.float16)[:, 0] for l in range(len(L1))]
-    for i, k in enumerate(ligand.index):
-        if len(ligand.loc[k].dropna()) > 1:
-            if adata.uns['mean'] == 'geometric':
-                L_mat[i] = gmean(adata[:, ligand.loc[k].dropna()].X, axis=1)
-            else:
-                L_mat[i] = adata[:, ligand.loc[k].dropna()].X.mean(1)
-
-    # averaged receptor values
-    R1 = [pd.Series(x[0]).dropna().values for x in receptor.values]
-    R_mat = [adata[:, R1[r]].X.astype(np.float16)[:, 0] for r in range(len(R1))]
-    for i, k in enumerate(receptor.index):
-        if len(receptor.loc[k].dropna()) > 1:
-            if adata.uns['mean'] == 'geometric':
-                R_mat[i] = gmean(adata[:, receptor.loc[k].dropna()].X, axis=1)
-            else:
-                R_mat[i] = adata[:, receptor.loc[k].dropna()].X.mean(1)
+    index = lr_index(adata).subset(sel_ind)
+    n_short_lri = (~index.secreted).sum()
+
+    # averaged ligand and receptor values, shared with extract_lr through the adata.obsm cache
+    L_mat, R_mat = _lr_means(adata, index, 'X', dtype=dtype, max_memory=max_memory)
 
     ## Check non-expressed pairs
-    idx_use = np.array([(L_mat[i].sum() > 0) * (R_mat[i].sum() > 0) for i in range(len(L_mat))])
+    idx_use = (L_mat.sum(1) > 0) & (R_mat.sum(1) > 0)
     if (np.mean(idx_use) < 1):
         print('Warning: some LR pairs have no expression.')
-    adata.uns['ligand'] = ligand.loc[idx_use]
-    adata.uns['receptor'] = receptor.loc[idx_use]
-    
-    if issparse(adata.X):
-        L_mat = csc_matrix(hstack(L_mat)).T
-        R_mat = csc_matrix(hstack(R_mat)).T
-        
-        # TODO: not support sparse matrix as intermediate results
-        L_mat = L_mat.toarray()
-        R_mat = R_mat.toarray()
-    else:
-        R_mat = np.array(R_mat)
-        L_mat = np.array(L_mat)
+    adata.uns['ligand'] = adata.uns['ligand'].loc[sel_ind].loc[idx_use]
+    adata.uns['receptor'] = adata.uns['receptor'].loc[sel_ind].loc[idx_use]
+    adata.uns['lr_index'] = index.subset(idx_use).to_dict()
 
+    # the graphs in adata.obsp are left as they are, products use a dtype copy (SpatialWeights.operand)
     R_mat_use = _standardise(R_mat[idx_use], axis=0)
     L_mat_use = _standardise(L_mat[idx_use], axis=0)
-    adata.uns['global_I'] = global_I_compute(adata, L_mat_use, R_mat_use, n_short_lri)
+    adata.uns['global_I'] = global_I_compute(adata, L_mat_use, R_mat_use, n_short_lri, nproc=nproc)
 
     ## Calculate p values
     if method in ['both', 'z-score']:
         adata.uns['global_stat']['z']['z'] = (
-            adata.uns['global_I'] / adata.uns['global_stat']['z']['st'])
+            adata.uns['global_I'] / adata.uns['global_stat']['z']['st']).astype(dtype)
         adata.uns['global_stat']['z']['z_p'] = stats.norm.sf(
-            adata.uns['global_stat']['z']['z'])
+            adata.uns['global_stat']['z']['z']).astype(dtype)
     if method in ['both', 'permutation']:
-        adata.uns['global_stat']['perm']['global_perm'] = np.zeros((L_mat_use.shape[1], n_perm))
-        for i in tqdm(range(n_perm)):
-            ## NOTE: most heavy computation, consider speedup in future (e.g., in parallel or tensor)
-            adata.uns['global_stat']['perm']['global_perm'][:, i] = global_I_compute(
-                adata, L_mat_use, R_mat_use, n_short_lri, permute=True
-            )
+        adata.uns['global_stat']['perm'].update(global_perm_compute(
+            adata, L_mat_use, R_mat_use, n_short_lri, n_perm, max_memory, nproc, seed, keep_perm))
 
 def norm_max(X):
     if type(X)==csr_matrix:
@@ -237,130 +762,324 @@ def norm_max(X):
     return X
 
 
-def spot_selection_matrix(adata, ligand, receptor, ind, n_perm, method, scale_X=True):
+def spot_selection_matrix(adata, index, ind, n_perm, method, scale_X=True, dtype=np.float32,
+                          max_memory=1024, nproc=1, seed=None, keep_perm=False, store=None):
     # local variables (only live in this function scope)
-    # normalize raw counts
-    raw_norm = adata.raw.to_adata()
-    raw_norm.X = csr_matrix([norm_max(X) for X in raw_norm.X.T]).T
-    import scanpy as sc
-    if scale_X:
-        sc.pp.scale(raw_norm, zero_center=False)
-    if adata.uns['mean'] == 'geometric':
-        from scipy.stats.mstats import gmean
-    L1 = [pd.Series(x[0]).dropna().values for x in ligand.values]
-    L_mat0 = [raw_norm[:, L1[l]].X.A.astype(np.float16)[:, 0] for l in range(len(L1))]
-    for i, k in enumerate(ligand.index):
-        if len(ligand.loc[k].dropna()) > 1:
-            if adata.uns['mean'] == 'geometric':
-                L_mat0[i] = gmean(raw_norm[:, ligand.loc[k].dropna()].X.A, axis=1)
-            else:
-                L_mat0[i] = raw_norm[:, ligand.loc[k].dropna()].X.A.mean(1)
-
-    # averaged receptor values
-    R1 = [pd.Series(x[0]).dropna().values for x in receptor.values]
-    R_mat0 = [raw_norm[:, R1[r]].X.A.astype(np.float16)[:, 0] for r in range(len(R1))]
-    for i, k in enumerate(receptor.index):
-        if len(receptor.loc[k].dropna()) > 1:
-            if adata.uns['mean'] == 'geometric':
-                R_mat0[i] = gmean(raw_norm[:, receptor.loc[k].dropna()].X.A, axis=1)
-            else:
-                R_mat0[i] = raw_norm[:, receptor.loc[k].dropna()].X.A.mean(1)
-    n_short_lri = (adata.uns['geneInter'].loc[ligand.index, 'annotation'] \
-                   != 'Secreted Signaling').sum()
-    ranges = [np.arange(n_short_lri), np.arange(n_short_lri, len(L1))]
-    weight_matrices = [adata.obsp['nearest_neighbors'], adata.obsp['weight']]
+    # averaged ligand and receptor values of the max-normalised raw counts, cached in adata.obsm
+    M, L_idx, R_idx = _lr_columns(adata, index, 'raw', scale_X, max_memory)
+    if issparse(M):
+        M = csc_matrix(M)
+    n_short_lri = (~index.secreted).sum()
+    ranges = [np.arange(n_short_lri), np.arange(n_short_lri, len(index))]
+    weight_keys = ['nearest_neighbors', 'weight']
     N = adata.shape[0]
-    L_mat0 = np.array(L_mat0)
-    R_mat0 = np.array(R_mat0)
-    pos = np.zeros((N, len(ligand)))
+    local_I, local_I_R = adata.uns['local_stat']['local_I'], adata.uns['local_stat']['local_I_R']
+    if method in ['both', 'permutation']:
+        seeds = _perm_seeds(seed, n_perm)
+        adata.uns['local_perm_p'] = _empty_store((len(index), N), dtype, store, 'local_perm_p')
+        # exceedance counts, in the smallest unsigned type holding n_perm
+        adata.uns['local_stat']['n_perm'] = n_perm
+        adata.uns['local_stat']['local_perm_n'] = _empty_store((len(index), N), np.min_scalar_type(n_perm),
+                                                              store, 'local_perm_n')
 
-    for r, weight_matrix in zip(ranges, weight_matrices):
+    for r, key in zip(ranges, weight_keys):
         if len(r) == 0:
             continue
-        R_mat = R_mat0[r].T
-        L_mat = L_mat0[r].T
-        R_mat_use = _standardise(R_mat, Local=True, axis=0)
-        L_mat_use = _standardise(L_mat, Local=True, axis=0)
-        pos[:, r] = (L_mat_use > 0) + (R_mat_use > 0)
-
-        if issparse(weight_matrix):
-            wij_sq = weight_matrix.power(2).sum(1).A.reshape(-1)
-        else:
-            wij_sq = (weight_matrix ** 2).sum(1)
-        rbf_d = csc_matrix(weight_matrix)
-        adata.uns['local_stat']['local_I'][:, r] = (rbf_d @ R_mat_use) * L_mat_use
-        adata.uns['local_stat']['local_I_R'][:, r] = (rbf_d @ L_mat_use) * R_mat_use
-            ## Calculate p values
-        if method in ['both', 'z-score']:
-            norm_res1 = [stats.norm.fit(L_mat_use[:, i]) for i in range(L_mat_use.shape[1])]
-            norm_res2 = [stats.norm.fit(R_mat_use[:, i]) for i in range(R_mat_use.shape[1])]
-            norm_res1 = np.array(norm_res1)
-            norm_res2 = np.array(norm_res2)
-            mu1_ls, std_L_ls = norm_res1[:, 0], norm_res1[:, 1]
-            mu2_ls, std_R_ls = norm_res2[:, 0], norm_res2[:, 1]
-            sigma1_sq_ls = [(std1 * N / (N - 1)) for std1 in std_L_ls]
-            sigma2_sq_ls = [(std2 * N / (N - 1)) for std2 in std_R_ls]
-            std_ls = [compute_var_local(adata, sigma1_sq, sigma2_sq, wij_sq, N) \
-                      for (sigma1_sq, sigma2_sq) in zip(sigma1_sq_ls, sigma2_sq_ls)]
-            adata.uns['local_z'][r] = (adata.uns['local_stat']['local_I'][:, r] + \
-                                       adata.uns['local_stat']['local_I_R'][:, r]).T / std_ls
-            adata.uns['local_z_p'][r] = stats.norm.sf(adata.uns['local_z'][r])
+        weights = spatial_weights(adata, key)
+        wij_sq = weights.sq_row_sums.astype(dtype)
 
+        # pairs in blocks: L / R and their standardised copies, W @ R / L and the z-score buffers
+        pair_block = _block_size(len(r), N, 1, np.dtype(dtype).itemsize, 8, max_memory, 1)
+        shared = {}
         if method in ['both', 'permutation']:
-            for i in tqdm(range(n_perm)):
-                _idx = np.random.permutation(L_mat.shape[0])
-                adata.uns['local_stat']['local_permI'][r, i, :] = ((rbf_d @ R_mat_use[_idx, :]) * L_mat_use).T
-                adata.uns['local_stat']['local_permI_R'][r, i, :] = ((rbf_d @ L_mat_use[_idx, :]) * R_mat_use).T
-
-    try:
-        adata.uns['local_z_p'] = np.where(pos.T == False, 1, adata.uns['local_z_p'])
-        adata.uns['local_z_p'] = pd.DataFrame(adata.uns['local_z_p'], index=ind, columns=adata.obs_names)
-    except Exception:
-        pass
-
-    try:
-        adata.uns['local_perm_p'] = (np.expand_dims(adata.uns['local_stat']['local_I'].T + \
-                                                    adata.uns['local_stat']['local_I_R'].T, 1) <= \
-                                     (adata.uns['local_stat']['local_permI'] + adata.uns['local_stat'][
-                                         'local_permI_R'])).sum(1) / n_perm
-        adata.uns['local_perm_p'] = np.where(pos.T == False, 1, adata.uns['local_perm_p'])
-        adata.uns['local_perm_p'] = pd.DataFrame(adata.uns['local_perm_p'], index=ind, columns=adata.obs_names)
-    except Exception:
-        pass
+            # one pool per graph, W shared once; its layout is chosen for the width of a full pair block
+            n_cols = min(pair_block, len(r))
+            block = _block_size(n_perm, N, n_cols, np.dtype(dtype).itemsize, 5, max_memory, nproc)
+            shared['W'] = weights.operand(matmul_kernel(weights, block * n_cols, 1, max_memory, dtype), dtype)
+        with _PermPool(nproc if shared else 1, shared) as pool:
+            for b in [r[i:i + pair_block] for i in range(0, len(r), pair_block)]:
+                R_mat_use = _standardise(_dense_columns(M, R_idx[b], dtype), Local=True, axis=0)
+                L_mat_use = _standardise(_dense_columns(M, L_idx[b], dtype), Local=True, axis=0)
+                pos = ((L_mat_use > 0) | (R_mat_use > 0)).T
+                local_I[:, b] = spatial_matmul(weights, R_mat_use, nproc=nproc, max_memory=max_memory) * L_mat_use
+                local_I_R[:, b] = spatial_matmul(weights, L_mat_use, nproc=nproc, max_memory=max_memory) * R_mat_use
+                obs = (local_I[:, b] + local_I_R[:, b]).T
+
+                ## Calculate p values
+                if method in ['both', 'z-score']:
+                    # MLE std of all ligand / receptor columns at once, variance as an (n_spots, n_pairs) outer product
+                    sigma_L = L_mat_use.std(0, dtype=np.float64) * N / (N - 1)
+                    sigma_R = R_mat_use.std(0, dtype=np.float64) * N / (N - 1)
+                    std_I = compute_var_local(adata, sigma_L, sigma_R, wij_sq[:, None], N).astype(dtype)
+                    adata.uns['local_z'][b] = obs / std_I.T
+                    adata.uns['local_z_p'][b] = np.where(pos, ndtr(-adata.uns['local_z'][b]), 1)
+
+                if method in ['both', 'permutation']:
+                    # stacked buffers per block: W @ permuted R / L, the two local I and their sum
+                    block = _block_size(n_perm, N, len(b), L_mat_use.dtype.itemsize, 5, max_memory, nproc)
+                    tasks = [(seeds[i:i + block], keep_perm) for i in range(0, n_perm, block)]
+                    res = pool.run(_local_perm_task, tasks, {'L': L_mat_use, 'R': R_mat_use, 'obs': obs})
+                    n_exceed = np.sum([x[0] for x in res], axis=0)
+                    adata.uns['local_stat']['local_perm_n'][b] = n_exceed
+                    adata.uns['local_perm_p'][b] = np.where(pos, n_exceed.astype(dtype) / n_perm, 1)
+                    if keep_perm:
+                        adata.uns['local_stat']['local_permI'][b] = np.concatenate([x[1] for x in res], axis=1)
+                        adata.uns['local_stat']['local_permI_R'][b] = np.concatenate([x[2] for x in res], axis=1)
+
+    if method in ['both', 'z-score']:
+        adata.uns['local_z_p'] = pd.DataFrame(adata.uns['local_z_p'], index=ind, columns=adata.obs_names,
+                                              copy=False)
+    if method in ['both', 'permutation']:
+        adata.uns['local_perm_p'] = pd.DataFrame(adata.uns['local_perm_p'], index=ind, columns=adata.obs_names,
+                                                 copy=False)
+
+def sparse_selection(p, threshold, max_memory=1024):
+    """Boolean CSR matrix of p < threshold, built in row chunks so no dense boolean copy is made.
+
+    :param p: (n_pairs, n_spots) p-values or fdr, array-like (may be memory-mapped)
+    :param max_memory: memory budget (MB) for one chunk of rows
+    """
+    chunk = max(1, int(max_memory * 1024 ** 2 // max(p.shape[1], 1)))
+    return vstack([csr_matrix(np.asarray(p[i:i + chunk]) < threshold) for i in range(0, p.shape[0], chunk)],
+                  format='csr')
+
+
+def _local_pairs(adata):
+    """Pairs of adata.uns['selected_spots'], as a dense frame or a sparse matrix from sig_spots(sparse=True)."""
+    if isinstance(adata.uns['selected_spots'], pd.DataFrame):
+        return adata.uns['selected_spots'].index
+    return pd.Index(adata.uns['local_stat']['pairs'])
+
+
+class LocalResults:
+    """Per-pair access to the local results of spatialdm_local / sig_spots.
+
+    Pair names are mapped to their position once, and every getter returns the spot vector of a single
+    pair, so looking up one pair does not scan or copy the (pairs x spots) arrays. With an AnnData the
+    arrays in adata.uns are indexed in place; with a SpatialDMStore (read_spatialdm_store) only the
+    chunk of the requested pair is read from disk.
+
+    :param source: AnnData object after spatialdm_local, or a SpatialDMStore
+    """
+
+    def __init__(self, source):
+        self.source = source
+        if isinstance(source, SpatialDMStore):
+            self.pairs = source.pairs
+            self.method = source.file['local'].attrs.get('local_method')
+        else:
+            local_stat = source.uns['local_stat']
+            self.method = local_stat.get('local_method')
+            if 'pairs' in local_stat:
+                self.pairs = pd.Index(local_stat['pairs'])
+            else:
+                self.pairs = (source.uns['local_z_p'] if 'local_z_p' in source.uns else source.uns['local_perm_p']).index
+        if self.method is None:
+            self.method = 'z-score' if self._has('local_z_p') else 'permutation'
+        self._pos = dict(zip(self.pairs, range(len(self.pairs))))
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __contains__(self, pair):
+        return pair in self._pos
+
+    def index(self, pair):
+        """Position of a pair in the local arrays"""
+        return self._pos[pair]
+
+    def _has(self, key):
+        if isinstance(self.source, SpatialDMStore):
+            return key in self.source
+        return key in self.source.uns or key in self.source.uns['local_stat']
+
+    def _row(self, key, pair):
+        i = self._pos[pair]
+        if isinstance(self.source, SpatialDMStore):
+            return self.source[key][i]
+        x = self.source.uns['local_stat'][key] if key in self.source.uns['local_stat'] else self.source.uns[key]
+        return x.values[i] if isinstance(x, pd.DataFrame) else x[i]
+
+    def _column(self, key, pair):
+        i = self._pos[pair]
+        if isinstance(self.source, SpatialDMStore):
+            return self.source[key][:, i]
+        return self.source.uns['local_stat'][key][:, i]
+
+    def local_I(self, pair):
+        """Local Moran's I of the ligand side of a pair, (n_spots,)"""
+        return self._column('local_I', pair)
+
+    def local_I_R(self, pair):
+        """Local Moran's I of the receptor side of a pair, (n_spots,)"""
+        return self._column('local_I_R', pair)
+
+    def z(self, pair):
+        """Local z-scores of a pair, (n_spots,)"""
+        return self._row('local_z', pair)
+
+    def p(self, pair):
+        """Local p-values of a pair that sig_spots thresholded: local_fdr if it adjusted them, else the raw
+        p-values of its method, (n_spots,)"""
+        if self._has('local_fdr'):
+            return self._row('local_fdr', pair)
+        return self._row('local_z_p' if self.method == 'z-score' else 'local_perm_p', pair)
+
+    def selected_spots(self, pair):
+        """Boolean mask of the selected spots of a pair, (n_spots,)"""
+        i = self._pos[pair]
+        if isinstance(self.source, SpatialDMStore):
+            return self.source.selected_spots([i]).toarray()[0]
+        sel = self.source.uns['selected_spots']
+        if isinstance(sel, pd.DataFrame):
+            return sel.values[i]
+        return sel[i].toarray()[0]
+
+    def fingerprint(self):
+        """Key of the local results, changing when they are recomputed: the store file and its modification \
+        time, or the per-pair sums of local I and local I_R of an AnnData"""
+        if isinstance(self.source, SpatialDMStore):
+            stat = os.stat(self.source.filename)
+            return _fingerprint(os.path.abspath(self.source.filename), stat.st_mtime_ns, stat.st_size)
+        local_stat = self.source.uns['local_stat']
+        return _fingerprint(np.asarray(self.pairs, dtype=str),
+                            np.asarray(local_stat['local_I'].sum(0), dtype=np.float64),
+                            np.asarray(local_stat['local_I_R'].sum(0), dtype=np.float64))
+
+    def n_spots(self, pair):
+        """Number of selected spots of a pair"""
+        i = self._pos[pair]
+        if isinstance(self.source, SpatialDMStore):
+            return int(self.source['n_spots'][i])
+        return int(self.source.uns['local_stat']['n_spots'].values[i])
+
+
+def _celltype_block(weights, C, L, R, nproc=1, max_memory=1024):
+    """(n_celltypes, n_celltypes, n_pairs) sums of W[i, j] * ct_L[j, source] * ct_R[i, target] for a block of pairs."""
+    N, n_ct = C.shape
+    X = (C[:, :, None] * L[:, None, :]).reshape(N, -1)
+    Y = spatial_matmul(weights, X, nproc=nproc, max_memory=max_memory).reshape(N, n_ct, -1)
+    Y *= R[:, None, :]
+    return (C.T @ Y.reshape(N, -1)).reshape(n_ct, n_ct, -1).transpose(1, 0, 2)
+
+
+def celltype_interactions(adata, pairs=None, results=None, dtype=np.float32, max_memory=1024, nproc=1):
+    """
+    Cell type x cell type communication of every pair, as shown by chord_celltype: for source (ligand) \
+    cell type s and target (receptor) cell type t, T[s, t, p] = sum_ij W[i, j] * ct_L[j, s] * ct_R[i, t] \
+    (ct_L.T @ W.T @ ct_R) with ct_L = local_I[:, p] * celltypes and ct_R = local_I_R[:, p] * celltypes, \
+    W the 'weight' (secreted pairs) or 'nearest_neighbors' graph. Pairs are computed in blocks by one \
+    sparse-dense product each, and cached in adata.uns['celltype_interactions'] until the cell types, \
+    the graphs or the local results change.
+    :param adata: AnnData after spatialdm_local, with cell type weights in adata.obsm['celltypes']
+    :param pairs: pairs of the local results, default to all of them
+    :param results: LocalResults to read local I from (e.g. of a SpatialDMStore), default to LocalResults(adata)
+    :param dtype: precision of the products
+    :param max_memory: memory budget (MB) for the buffers of one block of pairs
+    :param nproc: number of threads for the sparse products
+    :return: (n_celltypes, n_celltypes, len(pairs)) array indexed [source, target, pair], \
+    cell types in the order of adata.obsm['celltypes'].columns
+    """
+    if results is None:
+        results = LocalResults(adata)
+    pairs = results.pairs if pairs is None else pd.Index(pairs)
+    celltypes = adata.obsm['celltypes']
+    C = np.asarray(celltypes, dtype=dtype)
+    key = _fingerprint(np.asarray(celltypes.columns, dtype=str), C, dtype,
+                       spatial_weights(adata, 'weight').moments['key'],
+                       spatial_weights(adata, 'nearest_neighbors').moments['key'], results.fingerprint())
+    cache = adata.uns.get('celltype_interactions')
+    if cache is None or cache['key'] != key:
+        cache = {'key': key, 'pairs': np.array([], dtype=object),
+                 'tensor': np.zeros((C.shape[1], C.shape[1], 0), dtype=dtype)}
+
+    missing = pairs[~pairs.isin(cache['pairs'])].unique()
+    if len(missing) > 0:
+        secreted = lr_index(adata).subset(missing).secreted
+        block = _block_size(len(missing), C.shape[0], C.shape[1], np.dtype(dtype).itemsize, 3, max_memory, 1)
+        tensors, computed = [cache['tensor']], [cache['pairs']]
+        for w_key, use in [('weight', secreted), ('nearest_neighbors', ~secreted)]:
+            weights = spatial_weights(adata, w_key)
+            sub = missing[use]
+            for b in [sub[i:i + block] for i in range(0, len(sub), block)]:
+                L = np.column_stack([results.local_I(p) for p in b]).astype(dtype, copy=False)
+                R = np.column_stack([results.local_I_R(p) for p in b]).astype(dtype, copy=False)
+                tensors.append(_celltype_block(weights, C, L, R, nproc, max_memory))
+                computed.append(np.asarray(b, dtype=object))
+        cache = {'key': key, 'pairs': np.concatenate(computed).astype(str).astype(object),
+                 'tensor': np.concatenate(tensors, axis=2)}
+    adata.uns['celltype_interactions'] = cache
+    return cache['tensor'][:, :, pd.Index(cache['pairs']).get_indexer(pairs)]
+
+
+def pathway_membership(all_interactions):
+    """
+    Sparse pathway x interaction membership of an interaction table (e.g. adata.uns['geneInter']).
+    :param all_interactions: dataframe indexed by interaction with 'pathway_name' and 'interaction_name'
+    :return: pathways (sorted names), interactions (unique index), (n_pathways, n_interactions) binary \
+    csr matrix and the number of interactions of every pathway
+    """
+    pathway = all_interactions['pathway_name']
+    has_path = pathway.notna().values
+    pathways, path_code = np.unique(pathway[has_path].astype(str).values, return_inverse=True)
+    interactions = pd.Index(all_interactions.index).unique()
+    col = interactions.get_indexer(all_interactions['interaction_name'].values[has_path])
+    member = csr_matrix((np.ones((col >= 0).sum()), (path_code[col >= 0], col[col >= 0])),
+                        shape=(len(pathways), len(interactions)))
+    member.sum_duplicates()
+    member.data[:] = 1
+    return pathways, interactions, member, np.bincount(path_code, minlength=len(pathways))
+
 
 def compute_pathway(sample=None,
                     all_interactions=None,
         interaction_ls=None, name=None, dic=None):
     """
     Compute enriched pathways for a list of pairs or a dic of SpatialDE results.
+    All queries are tested against all pathways at once: the overlaps are one sparse product of the \
+    pathway membership and the query matrix, and the one-sided Fisher's exact p-values are \
+    hypergeometric tail probabilities.
     :param sample: spatialdm obj
     :param ls: a list of LR interaction names for the enrichment analysis
     :param path_name: str. For later recall sample.path_summary[path_name]
     :param dic: a dic of SpatialDE results (See tutorial)
+    :return: one row per query and pathway, indexed by pathway, with the columns 'fisher_p', 'pathway_size', \
+    'selected' (overlap size), 'selected_inters' (overlapping interactions) and 'name' (query)
     """
     if interaction_ls is not None:
         dic = {name: interaction_ls}
     if sample is not None:
         all_interactions = sample.uns['geneInter']
-    df = pd.DataFrame(all_interactions.groupby('pathway_name').interaction_name)
-    df = df.set_index(0)
+    pathways, interactions, member, pathway_size = pathway_membership(all_interactions)
     total_feature_num = len(all_interactions)
-    result = []
-    for n,ls in dic.items():
-        qset = set([x.upper() for x in ls]).intersection(all_interactions.index)
-        query_set_size = len(qset)
-        for modulename, members in df.iterrows():
-            module_size = len(members.values[0])
-            overlap_features = qset.intersection(members.values[0])
-            overlap_size = len(overlap_features)
-
-            negneg = total_feature_num + overlap_size - module_size - query_set_size
-            # Fisher's exact test
-            p_FET = stats.fisher_exact([[overlap_size, query_set_size - overlap_size],
-                                        [module_size - overlap_size, negneg]], 'greater')[1]
-            result.append((p_FET, modulename, module_size, overlap_size, overlap_features, n))
-    result = pd.DataFrame(result).set_index(1)
-    result.columns = ['fisher_p', 'pathway_size', 'selected', 'selected_inters', 'name']
+    names = list(dic.keys())
+
+    # interactions x queries, each query as the set of its (upper-cased) known interactions
+    rows = [interactions.get_indexer(pd.Index([x.upper() for x in dic[n]]).unique()) for n in names]
+    q_code = np.repeat(np.arange(len(names)), [len(r) for r in rows])
+    rows = np.concatenate(rows + [np.array([], dtype=np.int64)])
+    query = csr_matrix((np.ones((rows >= 0).sum()), (rows[rows >= 0], q_code[rows >= 0])),
+                       shape=(len(interactions), len(names)))
+    query_set_size = np.asarray(query.sum(0)).ravel().astype(int)
+    overlap = (member @ query).toarray().astype(int)
+
+    # Fisher's exact test, 'greater': P(X >= overlap) for X ~ hypergeom(total, pathway size, query size)
+    p_FET = np.clip(stats.hypergeom.sf(overlap - 1, total_feature_num, pathway_size[:, None],
+                                       query_set_size[None, :]), 0, 1)
+
+    # overlapping interactions of every (pathway, query) cell, joined on the interaction
+    m, q = member.tocoo(), query.tocoo()
+    hits = pd.DataFrame({'path': m.row, 'inter': m.col}).merge(pd.DataFrame({'inter': q.row, 'query': q.col}))
+    hits = hits.groupby(['query', 'path']).inter.agg(lambda x: set(interactions[x]))
+    cells = pd.MultiIndex.from_product([np.arange(len(names)), np.arange(len(pathways))])
+    selected_inters = hits.reindex(cells).apply(lambda x: x if isinstance(x, set) else set()).values
+
+    result = pd.DataFrame({'fisher_p': p_FET.T.ravel(),
+                           'pathway_size': np.tile(pathway_size, len(names)),
+                           'selected': overlap.T.ravel(),
+                           'selected_inters': selected_inters,
+                           'name': np.repeat(np.array(names, dtype=object), len(pathways))},
+                          index=np.tile(pathways.astype(object), len(names)))
     if sample is not None:
         sample.uns['pathway_summary'] = result
     return result